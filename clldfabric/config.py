@@ -10,6 +10,11 @@ Configuration of CLLD apps.
 """
 
 import os
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
+
 from six.moves.configparser import SafeConfigParser
 from pathlib import PurePosixPath as path
 
@@ -41,9 +46,25 @@ class App(object):
     @property
     def venv(self):
         """directory containing virtualenvs for clld apps.
+
+        For apps deployed as releases, this is a symlink to the active release.
         """
+        if getattr(self, 'releases', False):
+            return self.releases_dir.parent.joinpath('current')
         return path('/usr/venvs').joinpath(self.name)
 
+    @property
+    def releases_dir(self):
+        """directory containing the releases of an app, see clldfabric.release.
+        """
+        return path('/usr/venvs').joinpath(self.name, 'releases')
+
+    @property
+    def wheelhouse(self):
+        """directory containing the app's source and wheels for offline installs.
+        """
+        return self.home.joinpath('wheelhouse')
+
     @property
     def home(self):
         """home directory of the user running the app.
@@ -67,6 +88,12 @@ class App(object):
     def www(self):
         return self.home.joinpath('www')
 
+    @property
+    def snapshot(self):
+        """directory containing a static snapshot of the app's pages, see util.snapshot.
+        """
+        return self.www.joinpath('snapshot')
+
     @property
     def config(self):
         """path of the app's config file.
@@ -115,13 +142,17 @@ class App(object):
         return 'postgresql://{0}@/{0}'.format(self.name)
 
 
-class Config(dict):
+class Config(Mapping):
+    """Mapping of app names to App objects.
 
+    The config file is only read when the first app is looked up, and App objects are
+    only created when they are accessed, so that looking up one app is cheap.
+    """
     _filename = 'apps.ini'
 
     _getters = {
         'getint': ['workers', 'deploy_duration', 'port'],
-        'getboolean': ['with_blog', '_pages', 'pg_collkey'],
+        'getboolean': ['with_blog', '_pages', 'pg_collkey', 'releases', 'statsd'],
         'getlist': ['dependencies'],  # whitespace separated list
         'getlines': ['require_deb', 'require_pip'],  # newline separated list
     }
@@ -129,34 +160,50 @@ class Config(dict):
     def __init__(self):
         here = os.path.dirname(__file__)
         self.filename = os.path.join(here, self._filename)
+        self._parser = None
+        self._apps = {}
 
-        parser = SafeConfigParser()
-        parser.getlist = lambda s, o: parser.get(s, o).split()
-        parser.getlines = lambda s, o: [l.strip() for l in parser.get(s, o).splitlines() if l.strip()]
-        found = parser.read(self.filename)
-        if not found:
-            raise RuntimeError('failed to read app config %r' % self.filename)
-
+    @property
+    def parser(self):
+        if self._parser is None:
+            parser = SafeConfigParser()
+            parser.getlist = lambda s, o: parser.get(s, o).split()
+            parser.getlines = lambda s, o: [
+                l.strip() for l in parser.get(s, o).splitlines() if l.strip()]
+            found = parser.read(self.filename)
+            if not found:
+                raise RuntimeError('failed to read app config %r' % self.filename)
+
+            # some consistency checks: names and ports must be unique to make it
+            # possible to deploy each app on each server.
+            ports = [parser.getint(section, 'port') for section in parser.sections()]
+            assert len(ports) == len(set(ports))
+            self._parser = parser
+        return self._parser
+
+    def _items(self, section):
         getters = {}
         for attr, options in self._getters.items():
-            getters.update(dict.fromkeys(options, getattr(parser, attr)))
+            getters.update(dict.fromkeys(options, getattr(self.parser, attr)))
+
+        for o in self.parser.options(section):
+            yield o, getters.get(o, self.parser.get)(section, o)
 
-        def items(section):
-            for o in parser.options(section):
-                yield o, getters.get(o, parser.get)(section, o)
+    def __getitem__(self, name):
+        if name not in self._apps:
+            if not self.parser.has_section(name):
+                raise KeyError(name)
+            self._apps[name] = App(**dict([('name', name)] + list(self._items(name))))
+        return self._apps[name]
 
-        kwargs = [dict([('name', section)] + list(items(section)))
-            for section in parser.sections()]
-        apps = [App(**kw) for kw in kwargs]
+    def __contains__(self, name):
+        return self.parser.has_section(name)
 
-        # some consistency checks: names and ports must be unique to make it
-        # possible to deploy each app on each server.
-        names = [app.name for app in apps]
-        ports = [app.port for app in apps]
-        assert len(names) == len(set(names))
-        assert len(ports) == len(set(ports))
+    def __iter__(self):
+        return iter(self.parser.sections())
 
-        super(Config, self).__init__((app.name, app) for app in apps)
+    def __len__(self):
+        return len(self.parser.sections())
 
 
 APPS = Config()
@@ -0,0 +1,337 @@
+"""
+Management of app databases across servers.
+"""
+from __future__ import division
+import os
+import re
+import time
+import tempfile
+from io import BytesIO
+
+from fabric.api import sudo, run, local, put, env, execute, settings, hide
+
+from clldfabric.config import SERVERS
+from clldfabric import ssh
+from clldfabric.util import require, postgres, supervisor
+
+
+def server(app, name):
+    """resolve an environment name or server name to a server.
+    """
+    if name in ['production', 'test']:
+        return getattr(app, name)
+    if name not in SERVERS:
+        raise ValueError('unknown server %s' % name)
+    return name
+
+
+def _dump_dir(app):
+    return '/tmp/%s-dump' % app.name
+
+
+def version(program='pg_dump', remote=True):
+    """major version of a PostgreSQL client program, locally or on the current host.
+
+    :return: tuple of ints, e.g. (9, 3) or (12,) - since PostgreSQL 10 the major version \
+    is a single number.
+    """
+    cmd = '%s --version' % program
+    out = run(cmd) if remote else local(cmd, capture=True)
+    major, minor = map(int, re.search(r'(\d+)\.(\d+)', out).groups())
+    return (major,) if major >= 10 else (major, minor)
+
+
+def check_version(dump_version):
+    """make sure pg_restore on the current host can read a dump made by pg_dump of
+    version dump_version.
+    """
+    restore_version = version('pg_restore')
+    if restore_version < tuple(dump_version):
+        raise ValueError('pg_restore %s on %s cannot read dumps of pg_dump %s' % (
+            '.'.join(map(str, restore_version)),
+            env.host,
+            '.'.join(map(str, dump_version))))
+
+
+def _parallel(jobs):
+    """option to run pg_dump/pg_restore with parallel jobs, if supported.
+    """
+    # pg_restore supports parallel jobs since 8.4, pg_dump only since 9.3
+    if int(jobs) > 1 and version() >= (9, 3):
+        return '-j %s ' % jobs
+    return ''
+
+
+def _tables_option(tables, sequences=None):
+    """pg_dump options to dump the data of tables (and their sequences) only.
+
+    :param sequences: names of the sequences owned by the tables (see `sequences`).
+    """
+    if not tables:
+        return ''
+    return '-a %s ' % ' '.join(
+        "-t '%s'" % name for name in list(tables) + list(sequences or []))
+
+
+def dump(app, jobs=4, tables=None):
+    """dump the app's database into a directory.
+
+    :param tables: If specified, only the data of these tables is dumped.
+    :return: pair (size of the dump in bytes, seconds).
+    """
+    d = _dump_dir(app)
+    sudo('rm -rf %s' % d)
+    start = time.time()
+    sudo('sudo -u postgres pg_dump -x -O -Fd %s%s-f %s %s' % (
+        _parallel(jobs),
+        _tables_option(tables, sequences(tables, app.name) if tables else None),
+        d,
+        app.name))
+    duration = time.time() - start
+    # make the dump readable for the connecting user, who streams it to the target.
+    sudo('chown -R %s %s' % (env.user, d))
+    return int(run('du -sb %s' % d).split()[0]), duration
+
+
+def send(app, target_host):
+    """stream the dump to target_host, directly from server to server.
+
+    :return: seconds.
+    """
+    require.deb.package('pv')
+    start = time.time()
+    with settings(forward_agent=True):
+        run('tar -C /tmp -cf - {0} | pv -f -b -t -r -a | ssh -o BatchMode=yes {2} {1} '
+            '"rm -rf /tmp/{0} && tar -C /tmp -xf -"'.format(
+                _dump_dir(app).split('/')[-1], target_host, ssh.options()))
+    sudo('rm -rf %s' % _dump_dir(app))
+    return time.time() - start
+
+
+def restore(app, jobs=4, dump_version=None):
+    """replace the app's database with the dump, pausing the app meanwhile.
+
+    The dump is restored by the superuser, since it contains objects - like extensions or
+    the C functions of pg_collkey - which the app user may not create. Ownership of the
+    relations is then passed on to the app user.
+
+    :param dump_version: Version of the pg_dump which created the dump.
+    :return: seconds.
+    """
+    d = _dump_dir(app)
+    if dump_version:
+        check_version(dump_version)
+    sudo('chmod -R a+rX %s' % d)
+    supervisor(app, 'pause')
+    try:
+        start = time.time()
+        if postgres.database_exists(app.name):
+            sudo('sudo -u postgres dropdb %s' % app.name)
+        require.postgres.database(app.name, app.name)
+        sudo('sudo -u postgres pg_restore -x -O {0}-d {1} {2}'.format(
+            '-j %s ' % jobs if int(jobs) > 1 else '', app.name, d))
+        alter = [r[0] for r in _psql(OWNERSHIP_SQL.format(app.name), app.name)]
+        if alter:
+            _psql('\n'.join(alter), app.name)
+        duration = time.time() - start
+    finally:
+        supervisor(app, 'run')
+    sudo('rm -rf %s' % d)
+    return duration
+
+
+def _mb(size):
+    return size / 1024 / 1024
+
+
+def clone(app, source='production', target='test', jobs=4, target_host=None):
+    """clone the app's database from server source to server target.
+
+    The dump is streamed directly from source to target, thus the source server must be
+    able to connect to target via ssh - using the forwarded agent of the local user.
+
+    :param target_host: Host name of the target server as seen from the source server - \\
+    defaults to the server name.
+    """
+    source, target = server(app, source), server(app, target)
+    assert source != target
+
+    dump_version = execute(version, hosts=[source])[source]
+    size, dump_time = execute(dump, app, jobs=jobs, hosts=[source])[source]
+    print('--> dumped %.1f MB in %.1fs' % (_mb(size), dump_time))
+    send_time = execute(send, app, target_host or target, hosts=[source])[source]
+    print('--> sent %.1f MB in %.1fs (%.1f MB/s)' % (
+        _mb(size), send_time, _mb(size) / send_time if send_time else 0))
+    restore_time = execute(
+        restore, app, jobs=jobs, dump_version=dump_version, hosts=[target])[target]
+    print('--> restored in %.1fs' % restore_time)
+    return dict(size=size, dump=dump_time, send=send_time, restore=restore_time)
+
+
+# The text representation of the rows must not depend on the session's settings - e.g.
+# the local one when syncing from the local database - nor on the server version: With
+# extra_float_digits = 0, floats are rounded to 15 digits by all versions, whereas
+# higher values select the shortest exact representation on PostgreSQL >= 12 only.
+CHECKSUM_SETTINGS = """\
+SET extra_float_digits = 0;
+SET TimeZone = 'UTC';
+SET DateStyle = 'ISO, YMD';
+SET IntervalStyle = 'postgres';
+"""
+
+CHECKSUM_SQL = """\
+SELECT '{0}', count(*), md5(coalesce(string_agg(md5(t::text), '' ORDER BY md5(t::text)), ''))
+FROM "{0}" AS t"""
+
+# relations - except for sequences owned by a table, which follow the table - of the
+# public schema, which are not owned by the app user.
+OWNERSHIP_SQL = """\
+SELECT 'ALTER TABLE public.' || quote_ident(c.relname) || ' OWNER TO {0};'
+FROM pg_class AS c, pg_namespace AS n, pg_roles AS r
+WHERE c.relnamespace = n.oid AND n.nspname = 'public' AND c.relowner = r.oid
+AND r.rolname != '{0}' AND c.relkind IN ('r', 'S', 'v') AND NOT (c.relkind = 'S'
+AND EXISTS (SELECT 1 FROM pg_depend AS d WHERE d.objid = c.oid AND d.deptype = 'a'))"""
+
+SEQUENCES_SQL = """\
+SELECT s.relname
+FROM pg_class AS s, pg_depend AS d, pg_class AS t
+WHERE s.relkind = 'S' AND d.objid = s.oid AND d.deptype = 'a' AND d.refobjid = t.oid
+AND t.relname IN ({0})"""
+
+
+def _psql(sql, db_name, remote=True):
+    """run a query with psql as postgres, locally or on the current host.
+
+    :return: list of rows, i.e. lists of strings.
+    """
+    cmd = 'psql -X -q -A -t -F "|" -v ON_ERROR_STOP=1 -d %s -f %%s' % db_name
+    if remote:
+        fname = '/tmp/clldfabric-%s.sql' % db_name
+        put(BytesIO(sql.encode('utf8')), fname)
+        with hide('output'):
+            res = sudo('sudo -u postgres ' + cmd % fname)
+        run('rm %s' % fname)
+    else:
+        fd, fname = tempfile.mkstemp(suffix='.sql')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(sql.encode('utf8'))
+        try:
+            res = local(cmd % fname, capture=True)
+        finally:
+            os.remove(fname)
+    return [line.split('|') for line in res.splitlines() if line.strip()]
+
+
+def checksums(app, db_name=None, remote=True):
+    """compute row count and content checksum for each table of the database.
+
+    :return: dict mapping table names to pairs (row count, checksum).
+    """
+    db_name = db_name or app.name
+    tables = [r[0] for r in _psql(
+        "SELECT tablename FROM pg_tables WHERE schemaname = 'public' ORDER BY tablename",
+        db_name,
+        remote=remote)]
+    if not tables:
+        return {}
+    rows = _psql(
+        CHECKSUM_SETTINGS
+        + '\nUNION ALL\n'.join(CHECKSUM_SQL.format(t) for t in tables) + ';',
+        db_name,
+        remote=remote)
+    return dict((r[0], (int(r[1]), r[2])) for r in rows)
+
+
+def sequences(tables, db_name, remote=True):
+    """names of the sequences owned by columns of tables, e.g. serial primary keys.
+    """
+    return sorted(r[0] for r in _psql(
+        SEQUENCES_SQL.format(', '.join("'%s'" % t for t in tables)),
+        db_name,
+        remote=remote))
+
+
+def diff(source, target):
+    """determine the tables with different content.
+
+    :raises ValueError: if the sets of tables differ, i.e. the schema changed.
+    """
+    if set(source) != set(target):
+        raise ValueError(
+            'tables differ: %s - recreate the database instead' % ', '.join(
+                sorted(set(source).symmetric_difference(target))))
+    return sorted(t for t in source if source[t] != target[t])
+
+
+def restore_tables(app, tables, dump_version=None):
+    """replace the content of tables in the app's database with the data in the dump.
+
+    All changes are made in one transaction, so the app - which need not be paused -
+    sees either the old or the new data. Foreign key triggers are disabled for this
+    transaction, which is safe since the data is consistent when it is committed.
+
+    :param dump_version: Version of the pg_dump which created the dump.
+    :return: seconds.
+    """
+    d = _dump_dir(app)
+    if dump_version:
+        check_version(dump_version)
+    sudo('chmod -R a+rX %s' % d)
+    sql = '/tmp/%s-sync.sql' % app.name
+    put(BytesIO(('BEGIN;\nSET session_replication_role = replica;\n%s\n' % '\n'.join(
+        'DELETE FROM "%s";' % t for t in tables)).encode('utf8')), sql)
+    start = time.time()
+    sudo(
+        '(cat {0}; sudo -u postgres pg_restore -a -f - {1}; echo "COMMIT;") | '
+        'sudo -u postgres psql -X -q -v ON_ERROR_STOP=1 -d {2}'.format(sql, d, app.name))
+    sudo('sudo -u postgres psql -X -q -d {0} -c "ANALYZE {1};"'.format(
+        app.name, ', '.join('\\"%s\\"' % t for t in tables)))
+    duration = time.time() - start
+    sudo('rm -rf %s %s' % (d, sql))
+    return duration
+
+
+def _upload_dump(app):
+    d = _dump_dir(app)
+    require.files.file('%s.tgz' % d, source='%s.tgz' % d)
+    run('rm -rf {0} && tar -C /tmp -xzf {0}.tgz && rm {0}.tgz'.format(d))
+
+
+def sync(app, source='local', target='test', db_name=None, target_host=None):
+    """transfer only the tables which differ from the source to the target database.
+
+    :param source: "local" - i.e. the local database db_name - or a server or environment.
+    :param db_name: Name of the local database, defaults to the app name.
+    """
+    target = server(app, target)
+    remote_source = source != 'local'
+    if remote_source:
+        source = server(app, source)
+        src = execute(checksums, app, hosts=[source])[source]
+    else:
+        src = checksums(app, db_name=db_name, remote=False)
+    tables = diff(src, execute(checksums, app, hosts=[target])[target])
+    if not tables:
+        print('--> databases are in sync')
+        return []
+    print('--> tables to sync (rows in source): %s' % ', '.join(
+        '%s (%s)' % (t, src[t][0]) for t in tables))
+
+    if remote_source:
+        dump_version = execute(version, hosts=[source])[source]
+        execute(dump, app, jobs=1, tables=tables, hosts=[source])
+        execute(send, app, target_host or target, hosts=[source])
+    else:
+        dump_version = version(remote=False)
+        d = _dump_dir(app)
+        local('rm -rf {0} && pg_dump -x -O -Fd {1}-f {0} {2}'.format(
+            d,
+            _tables_option(tables, sequences(tables, db_name or app.name, remote=False)),
+            db_name or app.name))
+        local('tar -C /tmp -czf {0}.tgz {1}'.format(d, d.split('/')[-1]))
+        execute(_upload_dump, app, hosts=[target])
+        local('rm -rf {0} {0}.tgz'.format(d))
+    duration = execute(
+        restore_tables, app, tables, dump_version=dump_version, hosts=[target])[target]
+    print('--> synced %s tables in %.1fs' % (len(tables), duration))
+    return tables
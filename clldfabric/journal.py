@@ -0,0 +1,70 @@
+"""
+Journal of the steps of a deploy.
+
+A deploy is split into named steps. For each host and app, the completed steps of the
+last deploy - together with a fingerprint of their inputs and their results - are
+recorded in a local JSON file, so that a deploy which failed late can be resumed: a
+rerun skips completed steps up to the first step whose inputs changed or which did not
+complete. Once a deploy finished, the next one runs all steps again.
+"""
+from __future__ import print_function
+import os
+import json
+import hashlib
+from datetime import datetime
+
+JOURNAL_DIR = os.environ.get(
+    'CLLDFABRIC_JOURNAL', os.path.join(os.path.expanduser('~'), '.clldfabric', 'journal'))
+
+
+def fingerprint(*inputs):
+    return hashlib.md5(
+        json.dumps(inputs, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+class Journal(object):
+    """completed steps of the deploy of an app on a host.
+    """
+    def __init__(self, host, app, resume=True):
+        self.fname = os.path.join(JOURNAL_DIR, str(host), '%s.json' % app.name)
+        self.steps = []
+        # steps recorded by an incomplete previous deploy:
+        self.recorded = []
+        if resume and os.path.exists(self.fname):
+            with open(self.fname) as fp:
+                journal = json.load(fp)
+            if not journal['complete']:
+                self.recorded = journal['steps']
+
+    def _save(self, complete=False):
+        if not os.path.exists(os.path.dirname(self.fname)):
+            os.makedirs(os.path.dirname(self.fname))
+        with open(self.fname, 'w') as fp:
+            json.dump(dict(complete=complete, steps=self.steps), fp, indent=2)
+
+    def step(self, name, inputs, func, *args, **kw):
+        """run func as step name, unless it completed with the same inputs before.
+
+        :return: result of func - which must be JSON serializable - or the recorded result.
+        """
+        fp = fingerprint(inputs)
+        index = len(self.steps)
+        if index < len(self.recorded):
+            step = self.recorded[index]
+            if step['name'] == name and step['fingerprint'] == fp:
+                print('--> skipping step %s, completed %s' % (name, step['completed']))
+                self.steps.append(step)
+                return step['result']
+            # all subsequent steps must run again.
+            self.recorded = []
+        result = func(*args, **kw)
+        self.steps.append(dict(
+            name=name,
+            fingerprint=fp,
+            result=result,
+            completed=datetime.now().isoformat().split('.')[0]))
+        self._save()
+        return result
+
+    def complete(self):
+        self._save(complete=True)
@@ -0,0 +1,181 @@
+"""
+HTTP load tests for apps.
+
+A load test drives a mix of URLs against an app - at a fixed concurrency or at a fixed
+request rate - for a fixed duration. Results are stored per app and target (see
+clldfabric.stats) and compared with the previous run.
+
+The URL mix is read from a text file with one path per line, optionally preceded by a
+weight, e.g.::
+
+    5 /
+    2 /languages
+    1 /parameters/1
+"""
+from __future__ import division
+import time
+import random
+import threading
+
+from six.moves.urllib.request import urlopen
+from six.moves.urllib.error import HTTPError
+
+from clldfabric import stats
+
+DEFAULT_MIX = [(5, '/'), (1, '/_ping'), (2, '/languages'), (2, '/parameters'), (1, '/sources')]
+
+
+def base_url(app, target='local'):
+    """URL under which app can be reached:
+
+    - local: the app served by a local (or tunneled) server on its port,
+    - test: the app on its test server, under the URL configured as `test_url` in apps.ini -
+      the server names are ssh config aliases, which need not resolve for HTTP,
+    - production: the app under its domain.
+    """
+    if target == 'local':
+        return 'http://localhost:%s' % app.port
+    if target == 'test':
+        if not getattr(app, 'test_url', None):
+            raise ValueError(
+                'no test_url configured for %s - pass the URL as target' % app.name)
+        return app.test_url.rstrip('/')
+    if target == 'production':
+        return 'http://%s' % app.domain
+    return target.rstrip('/')
+
+
+def read_mix(fname=None):
+    if not fname:
+        return DEFAULT_MIX
+    res = []
+    with open(fname) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split()
+            res.append((float(parts[0]), parts[1]) if len(parts) > 1 else (1, parts[0]))
+    return res
+
+
+def _request(url):
+    start = time.time()
+    try:
+        res = urlopen(url, timeout=30)
+        res.read()
+        status = res.getcode()
+    except HTTPError as e:
+        status = e.code
+    except Exception:
+        status = None
+    return status, (time.time() - start) * 1000
+
+
+class _Pacer(object):
+    """hands out request slots at a fixed rate, shared by all clients.
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            slot, self.next = self.next, max(self.next, time.time()) + self.interval
+        delay = slot - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run(url, mix, duration=60, concurrency=10, rate=0):
+    """run the load test.
+
+    :param rate: Total requests per second; 0 means as fast as the clients can.
+    :return: list of triples (path, HTTP status or None, latency in ms).
+    """
+    paths, weights = [p for w, p in mix], [w for w, p in mix]
+    pacer = _Pacer(float(rate))
+    end = time.time() + float(duration)
+    results = []
+
+    def client():
+        rnd = random.Random()
+        while True:
+            pacer.wait()
+            if time.time() >= end:
+                return
+            path = _choice(rnd, paths, weights)
+            status, latency = _request(url + path)
+            results.append((path, status, latency))
+
+    threads = [threading.Thread(target=client) for _ in range(int(concurrency))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _choice(rnd, items, weights):
+    x = rnd.uniform(0, sum(weights))
+    for item, weight in zip(items, weights):
+        x -= weight
+        if x <= 0:
+            return item
+    return items[-1]
+
+
+def report(results, duration):
+    """
+    :param duration: Measured duration of the run in seconds - which exceeds the nominal \
+    one when requests stall.
+    """
+    ok = [r for r in results if r[1] and r[1] < 400]
+    latencies = [r[2] for r in ok]
+    return dict(
+        requests=len(results),
+        errors=len(results) - len(ok),
+        error_rate=(len(results) - len(ok)) / len(results) if results else None,
+        throughput=len(results) / duration,
+        latency=stats.summary(latencies),
+        histogram=stats.histogram(latencies),
+        paths=dict(
+            (path, stats.summary([r[2] for r in ok if r[0] == path]))
+            for path in sorted(set(r[0] for r in results))))
+
+
+COMPARE = [
+    'throughput', 'error_rate', 'latency.p50', 'latency.p90', 'latency.p99', 'latency.max']
+
+
+def loadtest(app, target='local', mix=None, duration=60, concurrency=10, rate=0):
+    """run a load test against app, store the results and compare with the previous run.
+    """
+    url = base_url(app, target)
+    start = time.time()
+    results = run(url, read_mix(mix), duration=duration, concurrency=concurrency, rate=rate)
+    elapsed = time.time() - start
+    result = report(results, elapsed)
+    result.update(
+        url=url,
+        duration=float(duration),
+        elapsed=round(elapsed, 1),
+        concurrency=int(concurrency),
+        rate=float(rate))
+
+    name = '%s-%s' % (app.name, target if target in ['local', 'test', 'production'] else 'url')
+    previous = stats.previous('loadtest', name)
+    fname = stats.save('loadtest', name, result)
+
+    print('%s: %s requests, %.1f req/s, %s errors' % (
+        url, result['requests'], result['throughput'], result['errors']))
+    lower = 0
+    for upper, count in result['histogram']:
+        print('%10s ms %8s' % ('<= %s' % upper if upper else '> %s' % lower, count))
+        lower = upper
+    print(stats.format_comparison(stats.compare(previous, result, COMPARE)))
+    print('--> results stored in %s' % fname)
+    return result
@@ -0,0 +1,70 @@
+"""
+Built-in monitoring with statsd, as alternative to newrelic.
+
+Apps configured with `statsd = true` in apps.ini are run by gunicorn with its statsd
+instrumentation instead of being wrapped by newrelic-admin. The metrics are sent to a
+small aggregator - one per host, run as supervisor program - which writes rolling
+request rate, latency and worker metrics to disk (see templates/statsd_aggregator.py).
+"""
+from __future__ import division
+import os
+import json
+
+from fabric.api import sudo, execute, hide
+
+from clldfabric.util import TEMPLATE_DIR, require, upload_template_as_root
+
+PORT = 8125
+SCRIPT = '/usr/local/lib/clldfabric/statsd_aggregator.py'
+DIRECTORY = '/var/lib/clldfabric/metrics'
+SUPERVISOR = '/etc/supervisor/conf.d/clldfabric-statsd.conf'
+
+COLUMNS = [
+    ('app', '%-18s'),
+    ('rate', '%8s'),
+    ('requests', '%9s'),
+    ('errors', '%7s'),
+    ('latency_mean', '%13s'),
+    ('latency_p90', '%12s'),
+    ('workers', '%8s'),
+]
+
+
+def require_aggregator():
+    """install and run the statsd aggregator on the current host.
+    """
+    require.files.directory(os.path.dirname(SCRIPT), use_sudo=True)
+    require.files.directory(DIRECTORY, owner='nobody', use_sudo=True)
+    require.files.file(
+        SCRIPT, source=os.path.join(TEMPLATE_DIR, 'statsd_aggregator.py'), use_sudo=True)
+    if upload_template_as_root(
+            SUPERVISOR,
+            'statsd-aggregator.conf',
+            dict(script=SCRIPT, directory=DIRECTORY, port=PORT),
+            mode='644'):
+        sudo('supervisorctl reread')
+        sudo('supervisorctl update clldfabric-statsd')
+
+
+def host_metrics(minutes=15):
+    """summarize the metrics of all apps on the current host.
+    """
+    with hide('output'):
+        res = sudo('python %s %s --summary --minutes %s' % (SCRIPT, DIRECTORY, minutes))
+    return json.loads(res.splitlines()[-1])
+
+
+def format_table(metrics, minutes=15):
+    lines = [' '.join(fmt % name for name, fmt in COLUMNS)]
+    for app in sorted(metrics):
+        m = dict(metrics[app]['%sm' % minutes], app=app)
+        lines.append(' '.join(
+            fmt % ('-' if m.get(name) is None else m[name]) for name, fmt in COLUMNS))
+    return '\n'.join(lines)
+
+
+def metrics(host, minutes=15):
+    res = execute(host_metrics, minutes=minutes, hosts=[host])[host]
+    print('%s - last %s minutes:' % (host, minutes))
+    print(format_table(res, minutes))
+    return res
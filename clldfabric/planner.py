@@ -0,0 +1,210 @@
+"""
+Capacity planning: which apps should be deployed on which server?
+
+Resource profiles of the apps - configured workers, measured memory per gunicorn process,
+database size and request rate from the nginx access log (which is rotated daily) - are
+compared with the capacity of the servers, to report overcommitted servers and to propose
+a balanced placement, shown as diff of apps.ini.
+"""
+from __future__ import division
+import re
+import difflib
+from io import BytesIO
+from collections import defaultdict
+
+from fabric.api import sudo, put, env, execute, settings, hide
+
+from clldfabric.config import APPS, SERVERS
+from clldfabric import status
+
+# memory per gunicorn process (in MB), if it can not be measured
+DEFAULT_RSS_MB = 150
+# fraction of a server's memory we are willing to spend on app processes
+HEADROOM = 0.8
+
+SCRIPT = """\
+echo "_host|memory|$(awk '/MemTotal/ {print int($2 / 1024)}' /proc/meminfo)"
+echo "_host|cpus|$(nproc)"
+"""
+APP_SCRIPT = """\
+echo "{0}|requests|$(cat /var/log/{0}/access.log 2>/dev/null | wc -l)"
+"""
+
+
+def server_profile(apps):
+    """measure the capacity of the current host and the request counts of its apps.
+    """
+    fname = '/tmp/clldfabric-capacity.sh'
+    put(BytesIO((SCRIPT + ''.join(
+        APP_SCRIPT.format(app.name) for app in apps.get(env.host, []))).encode('utf8')),
+        fname)
+    with hide('everything'):
+        out = sudo('bash %s; rm %s' % (fname, fname))
+    res = dict(memory_mb=0, cpus=1, requests={})
+    for line in out.splitlines():
+        try:
+            name, key, value = line.strip().split('|', 2)
+            value = int(value.strip() or 0)
+        except ValueError:
+            continue
+        if name == '_host':
+            res[key + '_mb' if key == 'memory' else key] = value
+        else:
+            res['requests'][name] = value
+    return res
+
+
+def app_profile(app, host, status=None, requests=0):
+    """
+    :param status: status of the app as returned by clldfabric.status.fleet.
+    :param requests: number of requests in the last day.
+    """
+    status = status or {}
+    processes = app.workers + 1
+    rss = DEFAULT_RSS_MB
+    if status.get('rss_mb') and status.get('workers'):
+        rss = status['rss_mb'] / (status['workers'] + 1)
+    return dict(
+        name=app.name,
+        host=host,
+        workers=app.workers,
+        memory_mb=round(processes * rss, 1),
+        db_mb=status.get('db_mb') or 0,
+        requests_per_s=round(requests / 86400, 3))
+
+
+def profiles(environment='production'):
+    """measure resource profiles of the apps in environment and the servers' capacity.
+
+    :return: pair (list of app profiles, dict of server profiles).
+    """
+    apps = defaultdict(list)
+    for app in APPS.values():
+        apps[getattr(app, environment)].append(app)
+    statuses = dict((s['app'], s) for s in status.fleet(environment))
+    with settings(
+            hide('running'),
+            parallel=True,
+            pool_size=len(SERVERS),
+            skip_bad_hosts=True,
+            warn_only=True):
+        res = execute(server_profile, apps, hosts=sorted(SERVERS))
+    servers = {}
+    for host in sorted(SERVERS):
+        if isinstance(res.get(host), dict):
+            servers[host] = res[host]
+        else:
+            print('--> Warning: %s could not be profiled, leaving out its apps' % host)
+    res = []
+    for host, host_apps in apps.items():
+        if host not in servers:
+            continue
+        for app in host_apps:
+            res.append(app_profile(
+                app,
+                host,
+                status=statuses.get(app.name),
+                requests=servers[host]['requests'].get(app.name, 0)))
+    return res, servers
+
+
+def loads(apps, servers, placement=None, headroom=HEADROOM):
+    """compute the load of each server.
+
+    :param placement: dict mapping app names to servers, defaults to the current one.
+    :return: dict mapping server names to load dicts.
+    """
+    placement = placement or dict((a['name'], a['host']) for a in apps)
+    res = dict(
+        (name, dict(
+            capacity_mb=server['memory_mb'] * headroom,
+            cpus=server['cpus'],
+            memory_mb=0,
+            workers=0,
+            db_mb=0,
+            requests_per_s=0,
+            apps=[]))
+        for name, server in servers.items())
+    for app in apps:
+        load = res[placement[app['name']]]
+        for key in ['memory_mb', 'workers', 'db_mb', 'requests_per_s']:
+            load[key] += app[key]
+        load['apps'].append(app['name'])
+    for load in res.values():
+        load['overcommitted'] = load['memory_mb'] > load['capacity_mb']
+    return res
+
+
+def place(apps, servers, headroom=HEADROOM):
+    """propose a balanced placement with a worst-fit decreasing bin-packing heuristic.
+
+    Apps are placed - biggest first - on the server with the lowest relative memory load
+    after placing the app. To avoid needless moves, an app stays on its current server,
+    as long as this server is not filled above the average fill ratio.
+
+    :return: dict mapping app names to servers.
+    """
+    capacity = dict((name, s['memory_mb'] * headroom) for name, s in servers.items())
+    fill = sum(a['memory_mb'] for a in apps) / (sum(capacity.values()) or 1)
+    load = dict.fromkeys(capacity, 0)
+    res = {}
+
+    def ratio(server, app):
+        return (load[server] + app['memory_mb']) / (capacity[server] or 1)
+
+    for app in sorted(apps, key=lambda a: (-a['memory_mb'], -a['requests_per_s'])):
+        if app['host'] in capacity and ratio(app['host'], app) <= max(fill, 0.5) * 1.1:
+            server = app['host']
+        else:
+            server = min(sorted(capacity), key=lambda s: ratio(s, app))
+        res[app['name']] = server
+        load[server] += app['memory_mb']
+    return res
+
+
+def assignment_diff(placement, environment='production'):
+    """unified diff of apps.ini implementing the placement.
+    """
+    with open(APPS.filename) as fp:
+        lines = fp.read().splitlines()
+    section, new = None, []
+    pattern = re.compile(r'^%s\s*=\s*(?P<server>\S+)' % environment)
+    for line in lines:
+        if line.startswith('['):
+            section = line.strip()[1:-1]
+        match = pattern.match(line)
+        if match and section in placement and placement[section] != match.group('server'):
+            line = '%s = %s' % (environment, placement[section])
+        new.append(line)
+    return '\n'.join(difflib.unified_diff(
+        lines, new, 'apps.ini', 'apps.ini (proposed)', lineterm=''))
+
+
+def format_loads(loads):
+    lines = ['%-12s %10s %10s %6s %8s %8s %10s' % (
+        'server', 'memory_mb', 'capacity', 'cpus', 'workers', 'req/s', 'db_mb')]
+    for name in sorted(loads):
+        load = loads[name]
+        lines.append('%-12s %10.0f %10.0f %6s %8s %8.2f %10.0f%s' % (
+            name,
+            load['memory_mb'],
+            load['capacity_mb'],
+            load['cpus'],
+            load['workers'],
+            load['requests_per_s'],
+            load['db_mb'],
+            '  OVERCOMMITTED' if load['overcommitted'] else ''))
+    return '\n'.join(lines)
+
+
+def capacity(environment='production', headroom=HEADROOM):
+    apps, servers = profiles(environment)
+    headroom = float(headroom)
+    print('current placement:')
+    print(format_loads(loads(apps, servers, headroom=headroom)))
+    placement = place(apps, servers, headroom=headroom)
+    print('\nproposed placement:')
+    print(format_loads(loads(apps, servers, placement=placement, headroom=headroom)))
+    print('')
+    print(assignment_diff(placement, environment) or '--> no changes proposed')
+    return placement
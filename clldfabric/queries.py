@@ -0,0 +1,160 @@
+"""
+Which SQL queries dominate an app's response time?
+
+deploy enables the pg_stat_statements extension on each host. From its statistics we
+pull the top queries of an app's database - by total and by mean time - together with
+the sequential and index scans of the app's tables. Snapshots are stored per app and
+server (see clldfabric.stats) and compared with the previous one, e.g. to check the
+effect of a new index or an alembic migration.
+"""
+from __future__ import division
+import re
+import hashlib
+
+from fabric.api import execute
+
+from clldfabric import stats
+from clldfabric.db import server, _psql
+
+# before PostgreSQL 9.2, total_time is reported in seconds rather than milliseconds.
+QUERIES_SQL = """\
+SELECT s.calls,
+s.total_time * CASE WHEN current_setting('server_version_num')::int < 90200
+THEN 1000 ELSE 1 END,
+s.rows, regexp_replace(s.query, '\\s+', ' ', 'g')
+FROM pg_stat_statements AS s, pg_database AS d
+WHERE s.dbid = d.oid AND d.datname = '{0}'"""
+
+TABLES_SQL = """\
+SELECT relname, seq_scan, seq_tup_read, coalesce(idx_scan, 0), n_live_tup
+FROM pg_stat_user_tables"""
+
+INDEXES_SQL = """\
+SELECT relname, indexrelname, idx_scan FROM pg_stat_user_indexes"""
+
+LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    # parameters first, since $1 would otherwise become $?
+    (re.compile(r'\$\d+'), '?'),
+    (re.compile(r'\b\d+(\.\d+)?([eE][-+]?\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(\s*,\s*\?)+\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize(query):
+    """replace literals and parameters, so that queries differing only in these match.
+    """
+    query = query.strip()
+    for pattern, repl in LITERALS:
+        query = pattern.sub(repl, query)
+    return query
+
+
+def query_id(query):
+    return hashlib.md5(query.encode('utf8')).hexdigest()[:10]
+
+
+def aggregate(rows):
+    """aggregate statistics of queries with the same normalized text.
+
+    :param rows: iterable of (calls, total_time, rows, query) tuples.
+    :return: dict mapping query ids to statistics.
+    """
+    res = {}
+    for calls, total, nrows, query in rows:
+        query = normalize(query)
+        q = res.setdefault(
+            query_id(query), dict(query=query, calls=0, total_ms=0.0, rows=0))
+        q['calls'] += int(calls)
+        q['total_ms'] += float(total)
+        q['rows'] += int(nrows)
+    total = sum(q['total_ms'] for q in res.values()) or 1
+    for q in res.values():
+        q['total_ms'] = round(q['total_ms'], 1)
+        q['mean_ms'] = round(q['total_ms'] / q['calls'], 2) if q['calls'] else None
+        q['percent'] = round(q['total_ms'] / total * 100, 1)
+    return res
+
+
+def collect(app):
+    """collect query, table and index statistics of the app's database on the current host.
+    """
+    # queries may contain the field separator, thus the query text is the last column.
+    queries = aggregate(
+        r[:3] + ['|'.join(r[3:])] for r in _psql(QUERIES_SQL.format(app.name), 'postgres'))
+    tables = dict(
+        (r[0], dict(
+            seq_scan=int(r[1]),
+            seq_tup_read=int(r[2]),
+            idx_scan=int(r[3]),
+            rows=int(r[4]),
+            unused_indexes=[]))
+        for r in _psql(TABLES_SQL, app.name))
+    for table, index, scans in _psql(INDEXES_SQL, app.name):
+        if table in tables and not int(scans):
+            tables[table]['unused_indexes'].append(index)
+    return dict(queries=queries, tables=tables)
+
+
+def top(queries, key='total_ms', n=20):
+    return sorted(
+        queries, key=lambda i: queries[i][key] or 0, reverse=True)[:int(n)]
+
+
+def format_result(result, n=20):
+    lines = []
+    for key in ['total_ms', 'mean_ms']:
+        lines.append('top queries by %s:' % key)
+        lines.append('%-10s %8s %12s %10s %6s  %s' % (
+            'id', 'calls', 'total_ms', 'mean_ms', '%', 'query'))
+        for i in top(result['queries'], key, n):
+            q = result['queries'][i]
+            lines.append('%-10s %8s %12.1f %10.2f %6.1f  %s' % (
+                i, q['calls'], q['total_ms'], q['mean_ms'] or 0, q['percent'],
+                q['query'][:120]))
+        lines.append('')
+    lines.append('%-30s %10s %14s %10s %10s  %s' % (
+        'table', 'seq_scan', 'seq_tup_read', 'idx_scan', 'rows', 'unused indexes'))
+    tables = result['tables']
+    for name in sorted(tables, key=lambda t: tables[t]['seq_tup_read'], reverse=True):
+        t = tables[name]
+        lines.append('%-30s %10s %14s %10s %10s  %s' % (
+            name, t['seq_scan'], t['seq_tup_read'], t['idx_scan'], t['rows'],
+            ', '.join(t['unused_indexes'])))
+    return '\n'.join(lines)
+
+
+def comparison_keys(result, n=20):
+    for i in top(result['queries'], 'total_ms', n):
+        yield 'queries.%s.mean_ms' % i
+    for name in sorted(result['tables']):
+        yield 'tables.%s.seq_scan' % name
+
+
+def slowqueries(app, environment='production', n=20, reset=False):
+    """show the top queries and table scans of the app's database and compare with the
+    previous snapshot.
+
+    :param reset: If set, reset the query statistics after the snapshot - note that this \
+    resets the statistics of all databases on the server.
+    """
+    host = server(app, environment)
+    result = execute(collect, app, hosts=[host])[host]
+    name = '%s-%s' % (app.name, host)
+    previous = stats.previous('slowqueries', name)
+    fname = stats.save('slowqueries', name, result)
+
+    print(format_result(result, n))
+    if previous:
+        print('\nchanges since %s:' % previous['timestamp'])
+        print(stats.format_comparison(
+            stats.compare(previous, result, comparison_keys(result, n))))
+    if reset:
+        execute(
+            _psql,
+            'SELECT pg_stat_statements_reset();',
+            'postgres',
+            hosts=[host])
+    print('--> snapshot stored in %s' % fname)
+    return result
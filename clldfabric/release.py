@@ -0,0 +1,184 @@
+"""
+Release artifacts: the virtualenv of an app - including its compiled assets - built once
+per app version and reused across hosts and redeploys.
+
+For apps configured with ``releases = True`` in apps.ini,
+
+- a release is identified by a hash over the app's requirements and the git revisions of
+  the app and its clld dependencies,
+- the release is built on the first host it is deployed to in
+  ``/usr/venvs/<app>/releases/<id>``, packed as tarball and cached locally,
+- on other hosts (and when redeploying) the cached tarball is uploaded and unpacked,
+- ``/usr/venvs/<app>/current`` - i.e. ``app.venv`` - is a symlink to the active release,
+  so switching between releases - and rolling back - is instant.
+
+Since a release is always unpacked at the path it was built in, the virtualenv need not
+be relocatable.
+"""
+import os
+import json
+import hashlib
+
+from fabric.api import sudo, local, get, cd
+from fabric.contrib.files import exists
+
+from clldfabric.util import require, virtualenv
+
+RELEASES_DIR = os.environ.get(
+    'CLLDFABRIC_RELEASES', os.path.join(os.path.expanduser('~'), '.clldfabric', 'releases'))
+
+# number of releases to keep on a host
+KEEP = 3
+
+_REVISIONS = {}
+
+
+def packages(app):
+    return [app.name] + getattr(app, 'dependencies', [])
+
+
+def revisions(app):
+    """current git revisions of the app and its clld dependencies.
+
+    The revisions are looked up once per fab run.
+    """
+    if app.name not in _REVISIONS:
+        res = {}
+        for name in packages(app):
+            out = local(
+                'git ls-remote https://github.com/clld/%s.git HEAD' % name, capture=True)
+            res[name] = out.split()[0]
+        _REVISIONS[app.name] = res
+    return _REVISIONS[app.name]
+
+
+def release_id(app, python, revs=None):
+    """compute the content address of a release of app.
+    """
+    spec = dict(
+        app=app.name,
+        python=python,
+        require_pip=sorted(app.require_pip),
+        revisions=revs or revisions(app))
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf8')).hexdigest()[:12]
+
+
+def local_tarball(app, rid):
+    return os.path.join(RELEASES_DIR, app.name, '%s.tgz' % rid)
+
+
+def _marker(app, rid):
+    return app.releases_dir.joinpath(rid, '.complete')
+
+
+def _build(app, rid, python, revs):
+    target = app.releases_dir.joinpath(rid)
+    sudo('virtualenv -q --python=%s %s' % (python, target))
+    with virtualenv(str(target)):
+        require.python.pip('6.0.6')
+        sudo('pip install -q %s' % ' '.join("'%s'" % req for req in app.require_pip))
+        for name in packages(app):
+            sudo('pip install -q -e git+https://github.com/clld/{0}.git@{1}#egg={0}'.format(
+                name, revs[name]))
+        sudo('webassets -m %s.assets build' % app.name)
+
+    tarball = '/tmp/%s-%s.tgz' % (app.name, rid)
+    sudo('tar -C %s -czf %s %s' % (app.releases_dir, tarball, rid))
+    fname = local_tarball(app, rid)
+    if not os.path.exists(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    get(tarball, fname)
+    sudo('rm %s' % tarball)
+    # Written last, so that a release directory left over by a failed build is not used.
+    sudo('touch %s' % _marker(app, rid))
+
+
+def _unpack(app, rid):
+    tarball = '/tmp/%s-%s.tgz' % (app.name, rid)
+    require.files.file(tarball, source=local_tarball(app, rid), use_sudo=True)
+    sudo('tar -C %s -xzf %s' % (app.releases_dir, tarball))
+    sudo('rm %s' % tarball)
+    sudo('touch %s' % _marker(app, rid))
+
+
+def current(app):
+    """id of the active release or None.
+    """
+    if exists(str(app.venv)):
+        return sudo('readlink %s' % app.venv).strip().split('/')[-1]
+
+
+def activate(app, rid):
+    """switch the current symlink to release rid.
+    """
+    prev = current(app)
+    if prev == rid:
+        return False
+    if prev:
+        # downloads are created within the app's source directory, so we carry them
+        # over to the new release.
+        downloads = 'src/{0}/{0}/static/download'.format(app.name)
+        src, dest = [app.releases_dir.joinpath(r, downloads) for r in [prev, rid]]
+        if exists(str(src)):
+            sudo('mkdir -p %s && cp -a %s/. %s' % (dest, src, dest))
+    # The modification time of the release directory serves as activation time.
+    sudo('touch %s' % app.releases_dir.joinpath(rid))
+    with cd(str(app.venv.parent)):
+        # rename(2) is atomic, so app.venv always points to a complete release.
+        sudo('ln -sfn releases/%s current.tmp && mv -T current.tmp current' % rid)
+    return True
+
+
+def releases(app):
+    """ids of the releases on the host, most recently activated first.
+    """
+    if not exists(str(app.releases_dir)):
+        return []
+    return sudo('ls -t %s' % app.releases_dir).split()
+
+
+def prune(app, keep=KEEP):
+    active = current(app)
+    for rid in releases(app)[keep:]:
+        if rid != active:
+            sudo('rm -rf %s' % app.releases_dir.joinpath(rid))
+
+
+def require_release(app, lsb_release):
+    """make sure the release for the current app version is active.
+
+    :return: True if a new release was activated.
+    """
+    python = 'python2.7' if lsb_release == 'precise' else 'python3'
+    revs = revisions(app)
+    rid = release_id(app, python, revs)
+    require.files.directory(str(app.releases_dir), use_sudo=True)
+
+    if current(app) == rid:
+        # the active release is complete, even if it was built before we used markers.
+        sudo('touch %s' % _marker(app, rid))
+    elif not exists(str(_marker(app, rid))):
+        # remove what is left of an incomplete build or unpack.
+        sudo('rm -rf %s' % app.releases_dir.joinpath(rid))
+        if os.path.exists(local_tarball(app, rid)):
+            _unpack(app, rid)
+        else:
+            _build(app, rid, python, revs)
+
+    res = activate(app, rid)
+    prune(app)
+    return res
+
+
+def rollback(app):
+    """activate the release which was active before the current one and restart the app.
+
+    :return: id of the activated release.
+    """
+    active, ids = current(app), releases(app)
+    older = ids[ids.index(active) + 1:] if active in ids else []
+    if not older:
+        raise ValueError('no release to roll back to')
+    activate(app, older[0])
+    sudo('supervisorctl restart %s' % app.name)
+    return older[0]
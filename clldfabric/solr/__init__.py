@@ -6,6 +6,7 @@ try:  # pragma: no cover
     import fabtools
 except ImportError:  # pragma: no cover
     pass
+from jinja2 import Template
 from path import path
 
 from clldfabric.config import APPS
@@ -52,6 +53,51 @@ def _content(p):
     return c
 
 
+def _clamp(value, lower, upper):
+    return max(lower, min(upper, int(value)))
+
+
+def core_profile(num_docs=10000, heap_mb=512, **kw):
+    """compute tuning parameters for a core from its expected size.
+
+    :param num_docs: Expected number of documents in the index.
+    :param heap_mb: Heap available to the servlet container (in MB).
+    :param kw: Explicit values overriding the computed ones.
+    :return: dict suitable as ``profile`` variable when rendering solrconfig.xml.
+    """
+    num_docs, heap_mb = int(num_docs), int(heap_mb)
+
+    # A filterCache entry may be a bitset with one bit per document, so we limit the
+    # cache to about 1/16 of the heap.
+    filter_cache = _clamp(heap_mb * 1024 * 1024 / 16 / max(num_docs / 8, 64), 64, 4096)
+    # queryResultCache entries are small lists of document ids.
+    query_result_cache = _clamp(heap_mb, 128, 4096)
+    # There is no point in caching more documents than there are in the index.
+    document_cache = _clamp(min(heap_mb * 2, num_docs), 128, 4096)
+
+    res = dict(
+        ram_buffer_mb=_clamp(heap_mb / 8, 16, 256),
+        # Small indexes are rebuilt from scratch in one go, so we can afford merging
+        # aggressively to keep the number of segments to search low.
+        merge_factor=5 if num_docs < 100000 else 10,
+        max_merged_segment_mb=_clamp(heap_mb * 4, 512, 5000),
+        hard_commit_ms=15000 if num_docs < 1000000 else 60000,
+        soft_commit_ms=-1,
+        filter_cache=dict(size=filter_cache, autowarm=min(filter_cache // 4, 256)),
+        query_result_cache=dict(size=query_result_cache, autowarm=query_result_cache // 8),
+        # documentCache can not be autowarmed, because internal document ids change.
+        document_cache=dict(size=document_cache, autowarm=0))
+    res.update(kw)
+    return res
+
+
+def solrconfig(name, profile=None):
+    """render solrconfig.xml for core `name`.
+    """
+    return Template(_content(SOLRCONFIG)).render(
+        data_dir=data_dir(name), profile=profile or core_profile())
+
+
 def core_dir(name, *comps):  # pragma: no cover
     args = [name] + list(comps)
     return SOLR_HOME.joinpath(*args)
@@ -92,8 +138,7 @@ def require_solr():  # pragma: no cover
             sudo('rm solr.tgz')
 
     create_file_as_root(
-        core_dir('collection1', 'conf', 'solrconfig.xml'),
-        _content(SOLRCONFIG) % data_dir('collection1'))
+        core_dir('collection1', 'conf', 'solrconfig.xml'), solrconfig('collection1'))
     create_file_as_root(core_dir('collection1', 'conf', 'schema.xml'), _content(SCHEMA))
 
     #
@@ -105,13 +150,12 @@ def require_solr():  # pragma: no cover
     restart_tomcat(check_path='/admin/ping')
 
 
-def require_core(name, schema=None):  # pragma: no cover
+def require_core(name, schema=None, profile=None):  # pragma: no cover
     if not exists(core_dir(name)):
         sudo('cp -R %s %s' % (core_dir('collection1'), core_dir(name)))
 
     create_file_as_root(
-        core_dir(name, 'conf', 'solrconfig.xml'),
-        _content(SOLRCONFIG) % data_dir(name))
+        core_dir(name, 'conf', 'solrconfig.xml'), solrconfig(name, profile=profile))
     create_file_as_root(core_dir(name, 'conf', 'schema.xml'), _content(SCHEMA))
 
     create_file_as_root(core_dir(name, 'core.properties'), 'name=%s' % name)
@@ -4,6 +4,7 @@ except ImportError:  # pragma: no cover
     pass
 
 from clldfabric import solr
+from clldfabric.solr import replay
 
 
 @task
@@ -12,8 +13,10 @@ def install():
 
 
 @task
-def createcore(name):
-    solr.require_core(name)  # pragma: no cover
+def createcore(name, docs=10000, heap=512):
+    """create or update a core, tuned for `docs` documents and `heap` MB of heap.
+    """
+    solr.require_core(name, profile=solr.core_profile(docs, heap))  # pragma: no cover
 
 
 @task
@@ -26,3 +29,13 @@ def dropindex(name):
     for data in ['<delete><query>*:*</query></delete>', '<commit/>']:
         run("curl http://localhost:8080/solr/%s/update --data '%s' "
             "-H 'Content-type:text/xml; charset=utf-8'" % (name, data))
+
+
+@task
+def benchmark(name, querylog, concurrency=4, warmup=100, url=replay.SOLR_URL):
+    """replay the queries in querylog against core name and report latencies.
+
+    Runs on the local machine, so to benchmark a remote Solr pass a tunneled url.
+    """
+    replay.benchmark(  # pragma: no cover
+        name, querylog, url=url, concurrency=concurrency, warmup=warmup)
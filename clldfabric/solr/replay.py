@@ -0,0 +1,142 @@
+"""
+Replay a recorded query log against a Solr core.
+
+The query log is a text file with one query per line, either given as URL query string
+(e.g. ``q=name:abc&rows=20``) or as Solr request log line, from which the ``params={...}``
+part is extracted.
+"""
+from __future__ import division
+import re
+import json
+import time
+import threading
+
+from six.moves import queue
+from six.moves.urllib.request import urlopen
+from six.moves.urllib.parse import parse_qsl, urlencode
+
+from clldfabric import stats
+
+SOLR_URL = 'http://localhost:8080/solr'
+CACHES = ['filterCache', 'queryResultCache', 'documentCache']
+PARAMS_PATTERN = re.compile(r'params=\{(?P<params>[^}]*)\}')
+
+
+def read_querylog(fname):
+    """read a query log, returning a list of lists of (key, value) pairs.
+    """
+    res = []
+    with open(fname) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            match = PARAMS_PATTERN.search(line)
+            if match:
+                line = match.group('params')
+            params = [(k, v) for k, v in parse_qsl(line) if k != 'wt']
+            if params:
+                res.append(params + [('wt', 'json')])
+    return res
+
+
+def cache_stats(core, url=SOLR_URL):
+    """retrieve cumulative lookup and hit counts of the core's caches.
+    """
+    res = json.loads(urlopen(
+        '%s/%s/admin/mbeans?stats=true&cat=CACHE&wt=json' % (url, core)).read().decode('utf8'))
+    mbeans = res['solr-mbeans']
+    caches = dict(zip(mbeans[::2], mbeans[1::2])).get('CACHE', {})
+    return dict(
+        (name, dict(
+            lookups=int(caches[name]['stats']['cumulative_lookups']),
+            hits=int(caches[name]['stats']['cumulative_hits'])))
+        for name in CACHES if name in caches)
+
+
+def hit_ratios(before, after):
+    res = {}
+    for name, values in after.items():
+        lookups = values['lookups'] - before.get(name, {}).get('lookups', 0)
+        hits = values['hits'] - before.get(name, {}).get('hits', 0)
+        res[name] = hits / lookups if lookups else None
+    return res
+
+
+def _worker(core, url, q, results):
+    while True:
+        try:
+            params = q.get_nowait()
+        except queue.Empty:
+            return
+        start = time.time()
+        try:
+            res = json.loads(
+                urlopen('%s/%s/select?%s' % (url, core, urlencode(params))).read().decode('utf8'))
+            results.append((res['responseHeader']['QTime'], (time.time() - start) * 1000))
+        except Exception:
+            results.append(None)
+
+
+def _run(core, url, queries, concurrency):
+    q = queue.Queue()
+    for params in queries:
+        q.put(params)
+    results = []
+    threads = [
+        threading.Thread(target=_worker, args=(core, url, q, results))
+        for _ in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.time() - start
+
+
+def replay(core, querylog, url=SOLR_URL, concurrency=4, warmup=100):
+    """replay the queries from querylog against core.
+
+    :param concurrency: Number of concurrent clients.
+    :param warmup: Number of queries from the start of the log which are run before \
+    measuring, to fill the caches.
+    :return: dict with latency percentiles (in ms), throughput and cache hit ratios.
+    """
+    queries = read_querylog(querylog)
+    warmup = min(int(warmup), len(queries))
+    concurrency = int(concurrency)
+    _run(core, url, queries[:warmup], concurrency)
+
+    before = cache_stats(core, url=url)
+    results, duration = _run(core, url, queries[warmup:], concurrency)
+    after = cache_stats(core, url=url)
+
+    ok = [r for r in results if r]
+    return dict(
+        core=core,
+        querylog=querylog,
+        concurrency=concurrency,
+        warmup=warmup,
+        queries=len(results),
+        errors=len(results) - len(ok),
+        duration=duration,
+        throughput=len(results) / duration if duration else None,
+        qtime=stats.summary([r[0] for r in ok]),
+        latency=stats.summary([r[1] for r in ok]),
+        hit_ratio=hit_ratios(before, after))
+
+
+COMPARE = [
+    'qtime.p50', 'qtime.p95', 'qtime.p99', 'latency.p50', 'latency.p95', 'latency.p99',
+    'throughput', 'errors'] + ['hit_ratio.%s' % name for name in CACHES]
+
+
+def benchmark(core, querylog, url=SOLR_URL, concurrency=4, warmup=100):
+    """run replay, store the result and print a comparison with the previous run.
+    """
+    previous = stats.previous('solr', core)
+    result = replay(core, querylog, url=url, concurrency=concurrency, warmup=warmup)
+    fname = stats.save('solr', core, result)
+    print(stats.format_comparison(stats.compare(previous, result, COMPARE)))
+    print('--> results stored in %s' % fname)
+    return result
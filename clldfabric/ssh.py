@@ -0,0 +1,84 @@
+"""
+Reuse of SSH connections.
+
+Within one fab run, fabric keeps one connection per host in a pool - the connection cache
+fabric.state.connections - and all tasks run on a host share it. Thus, chaining tasks in
+one invocation, e.g. `fab stop:production copy_files:production deploy:production`, pays
+the SSH handshake only once. When initialized - by clldfabric.tasks.init, i.e. from an
+app's fabfile - we count connections opened and reused - i.e. used again by a later
+task - keep pooled connections alive during long waits, and report the numbers when fab
+exits.
+
+Note that fabric's own connections are not reused across fab runs: fabric (i.e.
+paramiko) cannot use OpenSSH control sockets, and tunneling paramiko through one would
+not save its handshake. Only the ssh commands we run on the servers - e.g. to stream
+database dumps between servers - use a control master, persisting for the lifetime given
+by the environment variable CLLDFABRIC_SSH_PERSIST (default 10m), so that these
+connections are reused across runs.
+"""
+from __future__ import print_function
+import os
+import atexit
+
+from fabric import state
+from fabric.network import HostConnectionCache, normalize_to_string
+
+STATS = dict(opened=0, reused=0)
+# (host, task) pairs which have used a connection already
+USED = set()
+PERSIST = '10m'
+KEEPALIVE = 30
+
+
+class ConnectionPool(HostConnectionCache):
+    """fabric's connection cache, counting connections opened and reused.
+
+    The cache is accessed for each remote operation, thus a reuse is counted only once per
+    task and host.
+    """
+    def connect(self, key):
+        STATS['opened'] += 1
+        USED.add((normalize_to_string(key), state.env.command))
+        return HostConnectionCache.connect(self, key)
+
+    def __getitem__(self, key):
+        used = (normalize_to_string(key), state.env.command)
+        if key in self and used not in USED:
+            STATS['reused'] += 1
+            USED.add(used)
+        return HostConnectionCache.__getitem__(self, key)
+
+
+def report():
+    if STATS['opened']:
+        print('--> ssh connections: {opened} opened, {reused} reused'.format(**STATS))
+
+
+def pool(connections=None):
+    """instrument fabric's connection cache.
+
+    Since fabric modules import the cache by name, the instance is modified in place.
+    """
+    connections = state.connections if connections is None else connections
+    if not isinstance(connections, ConnectionPool):
+        connections.__class__ = ConnectionPool
+    return connections
+
+
+def init():
+    """instrument fabric's connection cache, keep connections alive and report the
+    connection statistics when fab exits.
+    """
+    if not isinstance(state.connections, ConnectionPool):
+        pool()
+        if not state.env.keepalive:
+            state.env.keepalive = KEEPALIVE
+        atexit.register(report)
+
+
+def options(persist=None):
+    """options for the OpenSSH client to share connections via a persistent control socket.
+    """
+    return '-o ControlMaster=auto -o ControlPath=~/.ssh/cm-%r@%h:%p ' \
+        '-o ControlPersist={0}'.format(
+            persist or os.environ.get('CLLDFABRIC_SSH_PERSIST', PERSIST))
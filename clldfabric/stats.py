@@ -0,0 +1,129 @@
+"""
+Simple statistics and local storage of benchmark results.
+
+Results of benchmark-like tasks are stored as JSON files in a local directory, one
+directory per kind of benchmark and subject (e.g. app or solr core), so that a new
+run can be compared with the previous one.
+"""
+from __future__ import division
+import os
+import json
+from datetime import datetime
+
+RESULTS_DIR = os.environ.get(
+    'CLLDFABRIC_RESULTS', os.path.join(os.path.expanduser('~'), '.clldfabric', 'results'))
+
+
+def percentile(values, p):
+    """compute the p-th percentile of values, using linear interpolation.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summary(values, percentiles=(50, 90, 95, 99)):
+    """summarize a list of numbers, e.g. latencies.
+    """
+    res = dict(count=len(values))
+    if values:
+        res.update(
+            min=min(values),
+            max=max(values),
+            mean=sum(values) / len(values))
+        for p in percentiles:
+            res['p%s' % p] = percentile(values, p)
+    return res
+
+
+def histogram(values, bins=(5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)):
+    """count values falling into the buckets delimited by the upper bounds in bins.
+
+    :return: list of pairs (upper bound, count), where the last bound is None.
+    """
+    counts = [0] * (len(bins) + 1)
+    for v in values:
+        for i, upper in enumerate(bins):
+            if v <= upper:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    return list(zip(list(bins) + [None], counts))
+
+
+def _dir(kind, name):
+    return os.path.join(RESULTS_DIR, kind, name)
+
+
+def save(kind, name, result):
+    """store a result, returning the path of the JSON file.
+    """
+    d = _dir(kind, name)
+    if not os.path.exists(d):
+        os.makedirs(d)
+    result.setdefault('timestamp', datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'))
+    fname = os.path.join(
+        d, '%s.json' % result['timestamp'].replace(':', '').replace('-', ''))
+    with open(fname, 'w') as fp:
+        json.dump(result, fp, indent=2, sort_keys=True)
+    return fname
+
+
+def results(kind, name):
+    """list stored results, oldest first.
+    """
+    d = _dir(kind, name)
+    if not os.path.exists(d):
+        return []
+    res = []
+    for fname in sorted(os.listdir(d)):
+        if fname.endswith('.json'):
+            with open(os.path.join(d, fname)) as fp:
+                res.append(json.load(fp))
+    return res
+
+
+def previous(kind, name):
+    """the most recently stored result or None.
+    """
+    res = results(kind, name)
+    return res[-1] if res else None
+
+
+def compare(old, new, keys):
+    """compare numbers in two results.
+
+    :param keys: iterable of dotted paths into the result dicts, e.g. "latency.p95".
+    :return: list of tuples (key, old value, new value, relative change in percent).
+    """
+    def get(d, key):
+        for k in key.split('.'):
+            if not isinstance(d, dict) or k not in d:
+                return None
+            d = d[k]
+        return d
+
+    res = []
+    for key in keys:
+        o, n = get(old or {}, key), get(new, key)
+        change = None
+        if o and n is not None:
+            change = (n - o) / o * 100
+        res.append((key, o, n, change))
+    return res
+
+
+def format_comparison(comparison):
+    lines = []
+    for key, o, n, change in comparison:
+        lines.append('%-30s %12s %12s %10s' % (
+            key,
+            '-' if o is None else '%.2f' % o,
+            '-' if n is None else '%.2f' % n,
+            '' if change is None else '%+.1f%%' % change))
+    return '\n'.join(lines)
@@ -0,0 +1,122 @@
+"""
+Status of all apps in the fleet.
+
+All hosts are queried in parallel, and all information about the apps on a host is
+collected by one script, i.e. with one round trip per host.
+"""
+from __future__ import division
+import json
+from io import BytesIO
+from collections import defaultdict
+
+from fabric.api import sudo, put, env, execute, settings, hide
+
+from clldfabric.config import APPS
+
+SCRIPT = """\
+echo "{0}|ping|$(curl -s -o /dev/null -m 10 -w '%{{http_code}} %{{time_total}}' \
+http://localhost:{1}/_ping)"
+echo "{0}|supervisor|$(supervisorctl status {0} | awk '{{print $2}}')"
+echo "{0}|processes|$(ps -u {0} -o rss= 2>/dev/null | awk '{{n++; s+=$1}} END {{print n+0, s+0}}')"
+echo "{0}|db|$(sudo -u postgres psql -X -A -t -c "SELECT pg_database_size('{0}')" 2>/dev/null)"
+"""
+
+COLUMNS = [
+    ('app', '%-18s'),
+    ('host', '%-12s'),
+    ('ping', '%-5s'),
+    ('latency_ms', '%10s'),
+    ('supervisor', '%-10s'),
+    ('workers', '%7s'),
+    ('rss_mb', '%8s'),
+    ('db_mb', '%8s'),
+]
+
+
+def parse(output, host):
+    """parse the output of the status script.
+
+    :return: list of dicts, one per app.
+    """
+    res = defaultdict(lambda: dict(host=host))
+    for line in output.splitlines():
+        try:
+            name, key, value = line.strip().split('|', 2)
+        except ValueError:
+            continue
+        status = res[name]
+        status['app'] = name
+        value = value.split()
+        if key == 'ping':
+            status['ping'] = 'ok' if value and value[0] == '200' else 'FAIL'
+            status['latency_ms'] = round(float(value[1]) * 1000, 1) \
+                if len(value) > 1 else None
+        elif key == 'supervisor':
+            status['supervisor'] = value[0] if value else None
+        elif key == 'processes' and len(value) == 2:
+            # gunicorn runs a master process and the workers as app user.
+            status['workers'] = max(int(value[0]) - 1, 0)
+            status['rss_mb'] = round(int(value[1]) / 1024, 1)
+        elif key == 'db':
+            status['db_mb'] = round(int(value[0]) / 1024 / 1024, 1) if value else None
+    return [res[name] for name in sorted(res)]
+
+
+def host_status(apps):
+    """collect the status of apps on the current host.
+    """
+    apps = apps[env.host]
+    fname = '/tmp/clldfabric-status.sh'
+    put(BytesIO(''.join(
+        SCRIPT.format(app.name, app.port) for app in apps).encode('utf8')), fname)
+    with hide('everything'):
+        out = sudo('bash %s; rm %s' % (fname, fname))
+    return parse(out, env.host)
+
+
+def unreachable(apps, host):
+    return [dict(app=app.name, host=host, ping='FAIL', supervisor='UNREACHABLE')
+            for app in apps]
+
+
+def fleet(environment='production'):
+    """collect the status of all apps deployed in environment.
+
+    :return: list of dicts, one per app.
+    """
+    apps = defaultdict(list)
+    for app in APPS.values():
+        apps[getattr(app, environment)].append(app)
+    with settings(
+            hide('running'),
+            parallel=True,
+            pool_size=len(apps),
+            skip_bad_hosts=True,
+            warn_only=True):
+        res = execute(host_status, apps, hosts=sorted(apps))
+    statuses = []
+    for host in sorted(apps):
+        # for a host which could not be queried, the result is an exception or None.
+        if isinstance(res.get(host), list):
+            statuses.extend(res[host])
+        else:
+            statuses.extend(unreachable(apps[host], host))
+    return sorted(statuses, key=lambda s: s['app'])
+
+
+def format_table(statuses):
+    lines = [' '.join(fmt % name for name, fmt in COLUMNS)]
+    for status in statuses:
+        lines.append(' '.join(
+            fmt % ('-' if status.get(name) is None else status[name])
+            for name, fmt in COLUMNS))
+    return '\n'.join(lines)
+
+
+def status(environment='production', format='table'):
+    statuses = fleet(environment)
+    if format == 'json':
+        print(json.dumps(statuses, indent=2, sort_keys=True))
+    else:
+        print(format_table(statuses))
+    return statuses
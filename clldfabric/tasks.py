@@ -13,6 +13,10 @@ from fabric.api import task, hosts, execute, env
 from clldfabric import config
 from clldfabric import util
 from clldfabric import varnish
+from clldfabric import release
+from clldfabric import db
+from clldfabric import ssh
+from clldfabric import status as _status
 
 
 APP = None
@@ -21,6 +25,7 @@ APP = None
 def init(app_name):
     global APP
     APP = config.APPS[app_name]
+    ssh.init()
 
 
 def _assign_host(environment):
@@ -29,8 +34,8 @@ def _assign_host(environment):
 
 
 @task
-def bootstrap(nr='y'):
-    util.bootstrap(nr=nr)  # pragma: no cover
+def bootstrap(nr='y', statsd='n'):
+    util.bootstrap(nr=nr, statsd=statsd)  # pragma: no cover
 
 
 @hosts('localhost')
@@ -82,13 +87,144 @@ def maintenance(environment, hours=2):
 
 @hosts('localhost')
 @task
-def deploy(environment, with_blog=False):
-    """deploy the app
+def snapshot(environment='production', concurrency=4, max_pages=10000):
+    """crawl a static snapshot of the app's pages, served while the app is down
+    """
+    _assign_host(environment)
+    execute(util.snapshot, APP, concurrency=concurrency, max_pages=max_pages)
+
+
+@hosts('localhost')
+@task
+def deploy(environment, with_blog=False, wheelhouse=False, fresh=False):
+    """deploy the app, resuming a previous deploy which failed
+
+    :param wheelhouse: If set, install from a local wheelhouse, which is (re)built if it \
+    doesn't exist yet or is stale.
+    :param fresh: If set, run all steps of the deploy, i.e. don't resume.
+    """
+    _assign_host(environment)
+    if not with_blog:
+        with_blog = getattr(APP, 'with_blog', False)
+    execute(
+        util.deploy,
+        APP,
+        environment,
+        with_blog=with_blog,
+        wheelhouse=bool(wheelhouse),
+        resume=not fresh)
+
+
+@task
+def wheelhouse(python_version=None):
+    """build (or update) a local wheelhouse for the app, to deploy with wheelhouse=y
+    """
+    from clldfabric import wheelhouse as _wheelhouse
+
+    print(_wheelhouse.build(APP, python_version or _wheelhouse.PYTHON_VERSION))
+
+
+@hosts('localhost')
+@task
+def plan(environment, with_blog=False):
+    """show the changes a deploy would make to the app's config files, without deploying
     """
     _assign_host(environment)
     if not with_blog:
         with_blog = getattr(APP, 'with_blog', False)
-    execute(util.deploy, APP, environment, with_blog=with_blog)
+    execute(util.plan, APP, environment, with_blog=with_blog)
+
+
+@hosts('localhost')
+@task
+def rollback(environment):
+    """switch back to the previous release of an app deployed as releases
+    """
+    _assign_host(environment)
+    execute(release.rollback, APP)
+
+
+@hosts('localhost')
+@task
+def clonedb(source='production', target='test', jobs=4, target_host=None):
+    """clone the app's database from one server (or environment) to another
+
+    :param target_host: Name of the target server as seen from the source server.
+    """
+    db.clone(APP, source, target, jobs=jobs, target_host=target_host)
+
+
+@hosts('localhost')
+@task
+def syncdb(environment, source='local', db_name=None, target_host=None):
+    """update only the tables of the app's database which differ from the source
+
+    :param source: "local" or a server or environment to copy the data from.
+    :param db_name: Name of the local source database.
+    """
+    db.sync(APP, source=source, target=environment, db_name=db_name, target_host=target_host)
+
+
+@hosts('localhost')
+@task
+def slowqueries(environment='production', top=20, reset=False):
+    """show the app's top SQL queries and table scans, compared with the previous run
+
+    :param top: Number of queries to show.
+    :param reset: If set, reset the query statistics (of all databases on the server).
+    """
+    from clldfabric import queries
+
+    queries.slowqueries(APP, environment, n=top, reset=reset)  # pragma: no cover
+
+
+@hosts('localhost')
+@task
+def status(environment='production', format='table'):
+    """show ping, latency, process state, memory and database size of all apps
+
+    :param format: "table" or "json".
+    """
+    _status.status(environment, format=format)
+
+
+@hosts('localhost')
+@task
+def capacity(environment='production', headroom=0.8):
+    """report overcommitted servers and propose a balanced placement of all apps
+
+    :param headroom: Fraction of a server's memory to be used by app processes.
+    """
+    from clldfabric import planner
+
+    planner.capacity(environment, headroom=headroom)  # pragma: no cover
+
+
+@hosts('localhost')
+@task
+def metrics(environment='production', minutes=15):
+    """show request rate, latency and workers of all apps on the app's server (statsd mode)
+
+    :param minutes: Length of the period to summarize.
+    """
+    from clldfabric import metrics as _metrics
+
+    _metrics.metrics(getattr(APP, environment), minutes=minutes)  # pragma: no cover
+
+
+@task
+def loadtest(target='local', mix=None, duration=60, concurrency=10, rate=0):
+    """drive a mix of URLs against the app and compare with the previous run
+
+    :param target: "local", "test" (requires test_url in apps.ini), "production" or a \
+    base URL.
+    :param mix: Path of a file listing (weighted) paths to request.
+    :param rate: Requests per second; by default requests are sent as fast as possible.
+    """
+    from clldfabric import loadtest as _loadtest
+
+    _loadtest.loadtest(  # pragma: no cover
+        APP, target, mix=mix, duration=duration, concurrency=concurrency, rate=rate)
 
 
 @hosts('localhost')
@@ -111,11 +247,12 @@ def uninstall(environment):
 
 @hosts('localhost')
 @task
-def create_downloads(environment):
-    """create all configured downloads
+def create_downloads(environment, processes=0, force=False, serial=False):
+    """create all configured downloads, skipping those up-to-date with the database
     """
     _assign_host(environment)
-    execute(util.create_downloads, APP)
+    execute(
+        util.create_downloads, APP, processes=processes, force=force, serial=serial)
 
 
 @hosts('localhost')
@@ -0,0 +1,124 @@
+"""
+Create the downloads of a clld app - running independent formats in parallel and skipping
+the ones which are up-to-date with the database.
+
+This script is uploaded to the server and run with the app's python:
+
+    python downloads.py config.ini#app [--processes N] [--force]
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from multiprocessing import Pool, cpu_count
+
+from sqlalchemy import text
+from pyramid.paster import bootstrap
+from clld.interfaces import IDownload
+from clld.db.meta import DBSession
+
+MANIFEST = '.manifest.json'
+
+ENV = {}
+
+
+def fingerprint():
+    """fingerprint of the database state, based on row counts and the last update of
+    each table.
+    """
+    tables = DBSession.execute(text(
+        "SELECT table_name, bool_or(column_name = 'updated') "
+        "FROM information_schema.columns WHERE table_schema = 'public' "
+        "GROUP BY table_name ORDER BY table_name")).fetchall()
+    md5 = hashlib.md5()
+    for table, with_updated in tables:
+        row = DBSession.execute(text('SELECT count(*)%s FROM "%s"' % (
+            ', max(updated)' if with_updated else '', table))).fetchone()
+        md5.update(('%s %s\n' % (table, ' '.join('%s' % v for v in row))).encode('utf8'))
+    return md5.hexdigest()
+
+
+def downloads():
+    return dict(ENV['registry'].getUtilitiesFor(IDownload))
+
+
+def outdated(paths, manifest, fp, force=False):
+    """
+    :param paths: dict mapping download names to the paths of their files.
+    :param manifest: dict mapping download names to the data recorded when created.
+    :param fp: fingerprint of the database.
+    :return: sorted list of names of the downloads which must be (re)created.
+    """
+    return [name for name in sorted(paths) if force
+            or manifest.get(name, {}).get('fingerprint') != fp
+            or not os.path.exists(paths[name])]
+
+
+def create(name):
+    dl = downloads()[name]
+    start = time.time()
+    try:
+        dl.create(ENV['request'])
+    except Exception as e:
+        return name, None, time.time() - start, '%s' % e
+    path = dl.abspath(ENV['request'])
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    return name, path, time.time() - start, size
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('config_uri')
+    parser.add_argument('--processes', type=int, default=0)
+    parser.add_argument('--force', action='store_true', default=False)
+    args = parser.parse_args(args)
+
+    ENV.update(bootstrap(args.config_uri))
+    dls = downloads()
+    if not dls:
+        return
+
+    fp = fingerprint()
+    manifest_path = os.path.join(
+        os.path.dirname(dls[sorted(dls)[0]].abspath(ENV['request'])), MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    todo = outdated(
+        dict((name, dl.abspath(ENV['request'])) for name, dl in dls.items()),
+        manifest,
+        fp,
+        force=args.force)
+    for name in sorted(set(dls) - set(todo)):
+        print('%-30s %10s' % (name, 'skipped'))
+
+    if todo:
+        # Connections must not be shared with the worker processes, so we close them
+        # before forking.
+        DBSession.remove()
+        DBSession.get_bind().dispose()
+        pool = Pool(args.processes or min(cpu_count(), len(todo)))
+        start = time.time()
+        try:
+            for name, path, duration, size in pool.imap_unordered(create, todo):
+                if path:
+                    manifest[name] = dict(fingerprint=fp, seconds=duration, size=size)
+                    print('%-30s %10s %8.1fs %12s' % (name, 'created', duration, size))
+                else:
+                    manifest.pop(name, None)
+                    print('%-30s %10s %8.1fs %s' % (name, 'FAILED', duration, size))
+        finally:
+            pool.close()
+            pool.join()
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+        print('%d of %d downloads created in %.1fs' % (len(todo), len(dls), time.time() - start))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
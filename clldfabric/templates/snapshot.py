@@ -0,0 +1,125 @@
+"""
+Crawl the public HTML pages of a clld app into a static snapshot, which nginx serves
+while the app is down.
+
+This script is uploaded to the server and run against the app's gunicorn port:
+
+    python snapshot.py http://localhost:PORT DOMAIN DIRECTORY \
+        [--concurrency N] [--max-pages N]
+
+Requests are sent with the Host header set to the app's domain - as nginx does - so that
+the absolute URLs in the pages point to the public site.
+
+The pages are written to a fresh directory which replaces DIRECTORY when the crawl is
+done, so that a complete snapshot is always in place. If most pages could not be fetched -
+e.g. because the app is down already - the old snapshot is kept and the script exits with
+status 1.
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib.request import urlopen, Request
+    from urllib.parse import urljoin, urlsplit, unquote
+    from urllib.error import HTTPError
+except ImportError:  # pragma: no cover
+    from urllib2 import urlopen, Request, HTTPError
+    from urlparse import urljoin, urlsplit
+    from urllib import unquote
+
+HREF = re.compile(r'href="(?P<url>[^"#]+)')
+# paths which are not part of the snapshot, because nginx serves them anyway or because
+# they are not public.
+SKIP = re.compile(r'^/(admin|static|clld-static|files|_ping)(/|$)')
+
+
+def fetch(base, host, path):
+    """
+    :return: triple (path, HTML or None, flag signaling failure).
+    """
+    try:
+        res = urlopen(
+            Request(base + path, headers={'Host': host, 'X-Scheme': 'http'}), timeout=60)
+        if res.getcode() != 200 or 'text/html' not in res.info().get('Content-Type', ''):
+            return path, None, False
+        return path, res.read(), False
+    except HTTPError as e:
+        return path, None, e.code >= 500
+    except Exception:
+        return path, None, True
+
+
+def links(host, path, html):
+    res = set()
+    for match in HREF.finditer(html.decode('utf8', 'replace')):
+        url = urlsplit(urljoin('http://' + host + path, match.group('url')))
+        if url.netloc == host and not url.query and not SKIP.match(url.path):
+            res.add(unquote(url.path) or '/')
+    return res
+
+
+def save(directory, path, html):
+    d = os.path.join(directory, *[p for p in path.split('/') if p not in ['', '.', '..']])
+    if not os.path.exists(d):
+        os.makedirs(d)
+    with open(os.path.join(d, 'index.html'), 'wb') as fp:
+        fp.write(html)
+    return len(html)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('base')
+    parser.add_argument('host')
+    parser.add_argument('directory')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--max-pages', type=int, default=10000)
+    args = parser.parse_args(args)
+
+    tmp = args.directory.rstrip('/') + '.new'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    start = time.time()
+    seen, todo, pages, failed, size = {'/'}, ['/'], 0, 0, 0
+    pool = ThreadPool(args.concurrency)
+    try:
+        while todo and pages < args.max_pages:
+            batch, todo = todo[:args.max_pages - pages], []
+            for path, html, error in pool.imap_unordered(
+                    lambda p: fetch(args.base, args.host, p), batch):
+                if html is None:
+                    failed += error
+                    continue
+                pages += 1
+                size += save(tmp, path, html)
+                for link in sorted(links(args.host, path, html) - seen):
+                    seen.add(link)
+                    todo.append(link)
+    finally:
+        pool.close()
+        pool.join()
+
+    res = dict(
+        pages=pages, failed=failed, bytes=size, seconds=round(time.time() - start, 1))
+    if not pages or failed > pages:
+        shutil.rmtree(tmp)
+        print(json.dumps(res))
+        return 1
+    if os.path.exists(args.directory):
+        shutil.rmtree(args.directory)
+    os.rename(tmp, args.directory)
+    print(json.dumps(res))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,167 @@
+"""
+A minimal statsd server, aggregating the metrics sent by the gunicorn processes of the
+apps on a host - to be run as supervisor program:
+
+    python statsd_aggregator.py DIRECTORY [--port 8125] [--interval 10] [--windows 360]
+
+Every interval seconds, request rate, latency percentiles, response status counts and
+number of workers of each app are computed and appended to DIRECTORY/APP.json, which
+holds the most recent windows only.
+
+    python statsd_aggregator.py DIRECTORY --summary [--minutes 1 5 15]
+
+prints a JSON summary of the metrics of all apps.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+from collections import defaultdict
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+class Window(object):
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.timers = defaultdict(list)
+        self.gauges = {}
+
+    def add(self, line):
+        """parse a statsd line like "wals3.gunicorn.request.duration:12.5|ms".
+        """
+        try:
+            name, rest = line.split(':', 1)
+            value, kind = rest.split('|')[:2]
+            value = float(value)
+        except ValueError:
+            return
+        if kind == 'c':
+            self.counters[name] += value
+        elif kind == 'ms':
+            self.timers[name].append(value)
+        elif kind == 'g':
+            self.gauges[name] = value
+
+    def metrics(self, seconds, gauges):
+        """compute the metrics of each app in the window.
+
+        :param gauges: gauges of previous windows, since gauges are only sent on change.
+        """
+        gauges.update(self.gauges)
+        res = defaultdict(lambda: dict(requests=0, status={}))
+        for name, value in self.counters.items():
+            app, _, metric = name.partition('.gunicorn.')
+            if metric == 'requests':
+                res[app]['requests'] = int(value)
+            elif metric.startswith('request.status.'):
+                res[app]['status'][metric.split('.')[-1]] = int(value)
+        for name, values in self.timers.items():
+            app, _, metric = name.partition('.gunicorn.')
+            if metric == 'request.duration':
+                res[app].update(
+                    latency_mean=sum(values) / len(values),
+                    latency_p50=percentile(values, 50),
+                    latency_p90=percentile(values, 90),
+                    latency_p99=percentile(values, 99))
+        for name, value in gauges.items():
+            app, _, metric = name.partition('.gunicorn.')
+            if metric == 'workers':
+                res[app]['workers'] = int(value)
+        for m in res.values():
+            m['rate'] = round(m['requests'] / seconds, 3)
+        return res
+
+
+def write(directory, app, window, max_windows):
+    fname = os.path.join(directory, '%s.json' % app)
+    windows = []
+    if os.path.exists(fname):
+        with open(fname) as fp:
+            windows = json.load(fp)
+    windows = (windows + [window])[-max_windows:]
+    with open(fname + '.tmp', 'w') as fp:
+        json.dump(windows, fp)
+    os.rename(fname + '.tmp', fname)
+
+
+def serve(args):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', args.port))
+    sock.settimeout(1)
+    window, start, gauges = Window(), time.time(), {}
+    while True:
+        try:
+            data = sock.recv(65535)
+            for line in data.decode('utf8', 'replace').splitlines():
+                window.add(line.strip())
+        except socket.timeout:
+            pass
+        now = time.time()
+        if now - start >= args.interval:
+            for app, metrics in window.metrics(now - start, gauges).items():
+                metrics.update(time=int(now), seconds=round(now - start, 1))
+                write(args.directory, app, metrics, args.windows)
+            window, start = Window(), now
+
+
+def summary(args):
+    res = {}
+    now = time.time()
+    for fname in sorted(os.listdir(args.directory)):
+        if not fname.endswith('.json'):
+            continue
+        with open(os.path.join(args.directory, fname)) as fp:
+            windows = json.load(fp)
+        app = res[fname[:-5]] = {}
+        for minutes in args.minutes:
+            recent = [w for w in windows if w['time'] > now - minutes * 60]
+            seconds = sum(w['seconds'] for w in recent)
+            requests = sum(w['requests'] for w in recent)
+            latencies = [w for w in recent if w.get('latency_mean') is not None]
+            errors = sum(
+                n for w in recent for s, n in w['status'].items() if s.startswith('5'))
+            app['%sm' % minutes] = dict(
+                requests=requests,
+                rate=round(requests / seconds, 3) if seconds else 0,
+                errors=errors,
+                # weighted by the number of requests in each window:
+                latency_mean=round(sum(
+                    w['latency_mean'] * w['requests'] for w in latencies) / max(
+                    sum(w['requests'] for w in latencies), 1), 1),
+                # the worst 90th percentile of the windows:
+                latency_p90=round(max([w['latency_p90'] for w in latencies] or [0]), 1),
+                workers=recent[-1].get('workers') if recent else None)
+    print(json.dumps(res))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('directory')
+    parser.add_argument('--port', type=int, default=8125)
+    parser.add_argument('--interval', type=int, default=10)
+    parser.add_argument('--windows', type=int, default=360)
+    parser.add_argument('--summary', action='store_true', default=False)
+    parser.add_argument('--minutes', type=int, nargs='+', default=[1, 5, 15])
+    args = parser.parse_args(args)
+    if args.summary:
+        summary(args)
+    else:
+        if not os.path.exists(args.directory):
+            os.makedirs(args.directory)
+        serve(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
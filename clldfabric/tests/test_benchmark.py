@@ -0,0 +1,194 @@
+"""
+Round-trip and timing benchmark for the deploy tooling.
+
+The tasks run against an instrumented fake transport, which counts remote calls and
+uploaded bytes and charges a simulated latency per round trip - plus the time spent in
+blocking sleeps. The results must stay within the budgets recorded in budgets.json.
+
+After an intended change, record new budgets by running the tests with
+CLLDFABRIC_RECORD_BUDGETS=1.
+"""
+from __future__ import print_function
+import os
+import json
+import shutil
+import tarfile
+import tempfile
+
+from mock import Mock, MagicMock, patch
+
+BUDGETS = os.path.join(os.path.dirname(__file__), 'budgets.json')
+
+# simulated latency of one round trip to a server, in seconds
+LATENCY = 0.05
+
+
+class Transport(object):
+    def __init__(self):
+        self.calls = 0
+        self.uploaded = 0
+        self.slept = 0
+
+    def call(self, result=None, upload=0):
+        self.calls += 1
+        self.uploaded += upload
+        return result
+
+    def command(self, result):
+        return Mock(side_effect=lambda *args, **kw: self.call(result))
+
+    def sleep(self, seconds):
+        self.slept += seconds
+
+    def local(self, command, **kw):
+        """local commands are free - but tarballs must be created to count their upload.
+
+        The size of a compressed archive depends on the tar and zlib implementations, so
+        we create an uncompressed archive with fixed metadata, i.e. budget the payload.
+        """
+        def normalize(info):
+            info.mtime, info.uid, info.gid, info.uname, info.gname = 0, 0, 0, '', ''
+            return info
+
+        args = command.split()
+        if args[0] == 'tar' and '-czf' in args:
+            with tarfile.open(
+                    args[args.index('-czf') + 1], 'w', format=tarfile.USTAR_FORMAT) as tar:
+                for name in args[args.index('-czf') + 2:]:
+                    tar.add(
+                        os.path.join(args[args.index('-C') + 1], name),
+                        arcname=name,
+                        filter=normalize)
+
+    def put(self, local_path, remote_path, **kw):
+        size = len(local_path.getvalue()) if hasattr(local_path, 'getvalue') \
+            else os.path.getsize(local_path)
+        self.call(upload=size)
+
+    def upload_template(self, template, dest, context=None, **kw):
+        from clldfabric.util import render_template
+
+        self.call(upload=len(render_template(template, context).encode('utf8')))
+
+    @property
+    def result(self):
+        return dict(
+            remote_calls=self.calls,
+            uploaded_bytes=self.uploaded,
+            seconds=round(self.calls * LATENCY + self.slept, 2))
+
+
+class Remote(object):
+    """stands in for the fabtools modules - each call counts as one round trip.
+    """
+    def __init__(self, transport, name=''):
+        self._transport = transport
+        self._name = name
+
+    def __getattr__(self, attr):
+        return Remote(self._transport, '%s.%s' % (self._name, attr))
+
+    def __call__(self, *args, **kw):
+        upload = 0
+        if kw.get('contents'):
+            upload = len(kw['contents'].encode('utf8'))
+        elif kw.get('source') and os.path.exists(kw['source']):
+            upload = os.path.getsize(kw['source'])
+        return self._transport.call(True, upload=upload)
+
+
+def measure(func, *args, **kw):
+    from fabric.utils import _AttributeDict
+    from clldutils.path import Path
+
+    t = Transport()
+    pkg = tempfile.mkdtemp()
+    os.makedirs(os.path.join(pkg, 'static', 'download'))
+    os.makedirs(os.path.join(pkg, 'files'))
+    for name, size in [
+        ('static/download/app.csv.zip', 1000),
+        ('static/download/app.n3.gz', 2000),
+        ('files/image.png', 5000),
+    ]:
+        with open(os.path.join(pkg, *name.split('/')), 'w') as fp:
+            fp.write('x' * size)
+    try:
+        with patch.multiple(
+                'clldfabric.util',
+                time=Mock(sleep=t.sleep),
+                getpass=Mock(return_value='password'),
+                confirm=Mock(return_value=False),
+                exists=t.command(True),
+                virtualenv=MagicMock(),
+                sudo=t.command('/usr/venvs/__init__.py'),
+                run=t.command('{"status": "ok"}'),
+                local=Mock(side_effect=t.local),
+                put=Mock(side_effect=t.put),
+                env=_AttributeDict(host='clld2', sudo_prefix='sudo -S -p x'),
+                service=Remote(t, 'service'),
+                cd=MagicMock(),
+                require=Remote(t, 'require'),
+                postgres=Remote(t, 'postgres'),
+                get_input=Mock(return_value=''),
+                import_module=Mock(return_value=Mock(
+                    __file__=os.path.join(pkg, '__init__.py'))),
+                upload_template=Mock(side_effect=t.upload_template),
+                data_file=Mock(return_value=Path(pkg))):
+            with patch('clldfabric.journal.JOURNAL_DIR', pkg), \
+                    patch('clldfabric.release.local', Mock(return_value='abc\tHEAD')):
+                func(*args, **kw)
+    finally:
+        shutil.rmtree(pkg)
+    return t.result
+
+
+def check(name, func, *args, **kw):
+    res = measure(func, *args, **kw)
+    budgets = {}
+    if os.path.exists(BUDGETS):
+        with open(BUDGETS) as fp:
+            budgets = json.load(fp)
+
+    if os.environ.get('CLLDFABRIC_RECORD_BUDGETS'):
+        budgets[name] = res
+        with open(BUDGETS, 'w') as fp:
+            json.dump(budgets, fp, indent=2, sort_keys=True, separators=(',', ': '))
+            fp.write('\n')
+
+    assert name in budgets, \
+        'no budget for %s - record it with CLLDFABRIC_RECORD_BUDGETS=1' % name
+
+    print(name, res)
+    for key, value in res.items():
+        assert value <= budgets[name][key], \
+            '%s: %s %s exceeds budget %s' % (name, key, value, budgets[name][key])
+
+
+def _app():
+    from clldfabric.config import Config
+
+    return Config()['testapp']
+
+
+def test_deploy():
+    from clldfabric.util import deploy
+
+    check('deploy', deploy, _app(), 'test', with_files=False)
+
+
+def test_copy_files():
+    from clldfabric.util import copy_files
+
+    check('copy_files', copy_files, _app())
+
+
+def test_copy_downloads():
+    from clldfabric.util import copy_downloads
+
+    check('copy_downloads', copy_downloads, _app())
+
+
+def test_supervisor():
+    from clldfabric.util import supervisor
+
+    check('supervisor', supervisor, _app(), 'run')
@@ -1,5 +1,12 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+
 from mock import Mock, MagicMock, patch
 from clldutils.path import Path
+from fabric.utils import _AttributeDict
 
 
 @patch.multiple('clldfabric.util',
@@ -7,12 +14,13 @@ from clldutils.path import Path
                 getpass=Mock(return_value='password'),
                 confirm=Mock(return_value=True),
                 exists=Mock(return_value=True),
+                append=Mock(),
                 virtualenv=MagicMock(),
                 sudo=Mock(return_value='/usr/venvs/__init__.py'),
                 run=Mock(return_value='{"status": "ok"}'),
                 local=Mock(),
                 put=Mock(),
-                env=MagicMock(),
+                env=_AttributeDict(host='clld2', sudo_prefix='sudo -S -p x'),
                 service=Mock(),
                 cd=MagicMock(),
                 require=Mock(),
@@ -20,28 +28,78 @@ from clldutils.path import Path
                 get_input=Mock(return_value='app'),
                 import_module=Mock(return_value=None),
                 upload_template=Mock(),
+                snapshot=Mock(),
                 data_file=Mock(return_value=Path('.')))
 def test_deploy():
-    from clldfabric.util import deploy, copy_files
+    from clldfabric import util
+    from clldfabric.util import deploy, copy_files, plan
     from clldfabric.config import Config
 
     app = Config()['testapp']
     assert app.src
-    deploy(app, 'test', with_files=False)
-    deploy(app, 'test', with_alembic=True, with_files=False)
-    deploy(app, 'production', with_files=False)
+    d = tempfile.mkdtemp()
+    try:
+        with patch('clldfabric.journal.JOURNAL_DIR', d), \
+                patch('clldfabric.release.revisions', Mock(return_value=dict(app='a'))):
+            deploy(app, 'test', with_files=False)
+            deploy(app, 'test', with_alembic=True, with_files=False)
+            deploy(app, 'production', with_files=False)
+    finally:
+        shutil.rmtree(d)
+    # the supervisor and app configs are uploaded, since they differ from the remote ones:
+    assert util.upload_template.called
     copy_files(app)
+    plan(app, 'production')
+
+
+@patch.multiple('clldfabric.util',
+                time=Mock(),
+                upload_template_as_root=Mock(return_value=False))
+def test_supervisor():
+    from clldfabric.util import supervisor
+
+    app = Mock()
+    app.name = 'app'
+    sudo = Mock(return_value='app   RUNNING   pid 1, uptime 1:00:00')
+    with patch('clldfabric.util.sudo', sudo):
+        supervisor(app, 'run', {}, restart=False)
+    assert sudo.call_count == 1
 
+    # a crashed app is restarted, even if its config did not change:
+    sudo = Mock(return_value='app   FATAL   Exited too quickly')
+    with patch('clldfabric.util.sudo', sudo):
+        supervisor(app, 'run', {}, restart=False)
+    sudo.assert_called_with('supervisorctl restart app')
 
-@patch.multiple('clldfabric.tasks', execute=Mock())
+
+@patch.multiple('clldfabric.util', upload_template=Mock(), env=dict())
+def test_upload_template_as_root():
+    import hashlib
+    from clldfabric import util
+
+    ctx = dict(app=Mock())
+    content = util.render_template('logrotate.conf', ctx)
+    md5 = hashlib.md5(content.encode('utf8')).hexdigest()
+    with patch('clldfabric.util.sudo', Mock(return_value=md5 + '  /etc/logrotate.d/app')):
+        assert not util.upload_template_as_root(
+            '/etc/logrotate.d/app', 'logrotate.conf', ctx)
+        assert not util.upload_template.called
+    with patch('clldfabric.util.sudo', Mock(return_value='')):
+        assert util.upload_template_as_root(
+            '/etc/logrotate.d/app', 'logrotate.conf', ctx)
+        assert util.upload_template.called
+
+
+@patch.multiple('clldfabric.tasks', execute=Mock(), ssh=Mock())
 def test_tasks():
     from clldfabric.tasks import (
         init, deploy, start, stop, maintenance, cache, uncache, run_script,
-        create_downloads, copy_files, uninstall,
+        create_downloads, copy_files, uninstall, plan, rollback, snapshot,
     )
 
     init('apics')
     deploy('test')
+    plan('test')
     stop('test')
     start('test')
     maintenance('test')
@@ -51,3 +109,378 @@ def test_tasks():
     create_downloads('test')
     copy_files('test')
     uninstall('test')
+    rollback('test')
+    snapshot()
+
+
+def test_snapshot_crawler():
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'templates'))
+    try:
+        import snapshot
+    finally:
+        sys.path.pop(0)
+
+    html = b'<a href="/languages">x</a><a href="/admin">x</a><a href="/static/x.css">' \
+        b'<a href="languages/abc?x=1">x</a><a href="http://example.org/">x</a>' \
+        b'<a href="/languages/abc#top">'
+    assert snapshot.links('localhost:8000', '/', html) == \
+        {'/languages', '/languages/abc'}
+    d = tempfile.mkdtemp()
+    try:
+        assert snapshot.save(d, '/languages/../abc', html) == len(html)
+        assert os.path.exists(os.path.join(d, 'languages', 'abc', 'index.html'))
+
+        # if the app is down, the previous snapshot is kept:
+        assert snapshot.main(['http://localhost:9', 'localhost', d]) == 1
+        assert os.path.exists(os.path.join(d, 'languages', 'abc', 'index.html'))
+    finally:
+        shutil.rmtree(d)
+
+
+def test_downloads_outdated():
+    # the script runs with the app's python, thus the app's dependencies are not needed
+    # to test the skip decision.
+    modules = dict((name, Mock()) for name in [
+        'sqlalchemy', 'pyramid', 'pyramid.paster', 'clld', 'clld.interfaces', 'clld.db',
+        'clld.db.meta'])
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'templates'))
+    try:
+        with patch.dict('sys.modules', modules):
+            import downloads
+    finally:
+        sys.path.pop(0)
+
+    paths = dict(csv=__file__, n3=__file__ + '.missing', rdf=__file__)
+    manifest = dict(csv=dict(fingerprint='abc'), n3=dict(fingerprint='abc'))
+    assert downloads.outdated(paths, manifest, 'abc') == ['n3', 'rdf']
+    assert downloads.outdated(paths, manifest, 'def') == ['csv', 'n3', 'rdf']
+    assert downloads.outdated(paths, manifest, 'abc', force=True) == ['csv', 'n3', 'rdf']
+
+
+def test_statsd():
+    from clldfabric.config import Config
+    from clldfabric.util import get_template_variables, render_template
+
+    app = Config()['testapp']
+    assert not app.statsd
+    app.statsd = True
+    conf = render_template('supervisor.conf', get_template_variables(app))
+    assert '--statsd-prefix testapp' in conf and 'newrelic' not in conf
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'templates'))
+    try:
+        import statsd_aggregator as aggregator
+    finally:
+        sys.path.pop(0)
+
+    window = aggregator.Window()
+    for line in [
+        'testapp.gunicorn.requests:1|c',
+        'testapp.gunicorn.requests:1|c',
+        'testapp.gunicorn.request.status.500:1|c',
+        'testapp.gunicorn.request.duration:10|ms',
+        'testapp.gunicorn.request.duration:30|ms',
+        'testapp.gunicorn.workers:3|g',
+        'other.gunicorn.workers:2|g',
+        'invalid',
+    ]:
+        window.add(line)
+    metrics = window.metrics(10, {})
+    assert metrics['testapp']['rate'] == 0.2
+    assert metrics['testapp']['latency_mean'] == 20
+    assert metrics['other'] == dict(requests=0, status={}, workers=2, rate=0)
+    d = tempfile.mkdtemp()
+    try:
+        for t in range(3):
+            aggregator.write(d, 'testapp', dict(metrics['testapp'], time=t), 2)
+        with open(os.path.join(d, 'testapp.json')) as fp:
+            assert [w['time'] for w in json.load(fp)] == [1, 2]
+    finally:
+        shutil.rmtree(d)
+
+
+def test_journal():
+    from clldfabric.config import Config
+    from clldfabric import journal
+
+    app = Config()['testapp']
+    step = Mock(return_value=True)
+    d = tempfile.mkdtemp()
+    try:
+        with patch('clldfabric.journal.JOURNAL_DIR', d):
+            j = journal.Journal('clld2', app)
+            assert j.step('install', ['a'], step) is True
+            j.step('nginx', ['b'], step)
+
+            # a failed deploy is resumed, up to the first step with changed inputs:
+            j = journal.Journal('clld2', app)
+            assert j.step('install', ['a'], Mock()) is True
+            j.step('nginx', ['c'], step)
+            assert step.call_count == 3
+            j.complete()
+
+            # a complete deploy is not resumed:
+            j = journal.Journal('clld2', app)
+            j.step('install', ['a'], step)
+            assert step.call_count == 4
+            assert not journal.Journal('clld2', app, resume=False).recorded
+    finally:
+        shutil.rmtree(d)
+
+
+def test_wheelhouse():
+    from clldfabric.config import Config
+    from clldfabric import wheelhouse
+
+    app = Config()['glottologcurator']
+    assert wheelhouse.packages(app) == ['glottologcurator', 'glottolog3']
+    assert wheelhouse.tarball(app, '3.4').endswith('py3.4/wheelhouse.tgz')
+    match = wheelhouse.WHEEL_PATTERN.match('psycopg2-2.6.1-cp34-cp34m-linux_x86_64.whl')
+    assert match.group('name') == 'psycopg2' and match.group('platform') == 'linux_x86_64'
+    with patch.dict('os.environ', CLLDFABRIC_PYTHON27='/opt/py27/bin/python'):
+        assert wheelhouse.interpreter('2.7') == '/opt/py27/bin/python'
+        assert wheelhouse.interpreter('3.4') == 'python3.4'
+
+    d = tempfile.mkdtemp()
+    try:
+        with patch('clldfabric.wheelhouse.WHEELHOUSE_DIR', d):
+            revs = dict(glottologcurator='abc', glottolog3='def')
+            assert wheelhouse.is_stale(app, '3.4', revs)
+            os.makedirs(wheelhouse.local_dir(app, '3.4'))
+            open(wheelhouse.tarball(app, '3.4'), 'w').close()
+            with open(wheelhouse.manifest(app, '3.4'), 'w') as fp:
+                json.dump(wheelhouse._spec(app, revs), fp)
+            assert not wheelhouse.is_stale(app, '3.4', revs)
+            assert wheelhouse.is_stale(app, '3.4', dict(revs, glottolog3='xyz'))
+    finally:
+        shutil.rmtree(d)
+
+
+def test_release():
+    from clldfabric.config import App
+    from clldfabric import release
+
+    app = App('app', 9999, test='clld2', production='clld2', require_pip=['a', 'b'])
+    assert str(app.venv) == '/usr/venvs/app'
+    revs = dict(app='abc')
+    rid = release.release_id(app, 'python3', revs)
+    assert rid == release.release_id(app, 'python3', revs)
+    assert rid != release.release_id(app, 'python2.7', revs)
+
+    app.releases = True
+    assert str(app.venv) == '/usr/venvs/app/current'
+    assert str(app.releases_dir.joinpath(rid)).startswith('/usr/venvs/app/releases/')
+
+    # an incomplete release directory is removed and built again:
+    sudo, build = Mock(), Mock()
+    with patch.multiple(
+            'clldfabric.release',
+            revisions=Mock(return_value=revs),
+            require=Mock(),
+            exists=Mock(return_value=False),
+            sudo=sudo,
+            _build=build,
+            activate=Mock(return_value=True),
+            prune=Mock()):
+        assert release.require_release(app, 'trusty')
+    sudo.assert_any_call('rm -rf %s' % app.releases_dir.joinpath(rid))
+    assert build.called
+
+    # revisions are looked up once, and a failed lookup doesn't abort a deploy:
+    from clldfabric.util import _revisions
+
+    with patch.dict('clldfabric.release._REVISIONS', {}):
+        with patch('clldfabric.release.local', Mock(return_value='')):
+            assert _revisions(app) is None
+        local = Mock(return_value='abc\tHEAD')
+        with patch('clldfabric.release.local', local):
+            assert _revisions(app) == dict(app='abc') == release.revisions(app)
+        assert local.call_count == 1
+
+
+def test_db_server():
+    from clldfabric.config import Config
+    from clldfabric.db import server
+
+    app = Config()['wals3']
+    assert server(app, 'production') == 'harald'
+    assert server(app, 'uri') == 'uri'
+    try:
+        server(app, 'localhost')
+        assert False  # pragma: no cover
+    except ValueError:
+        pass
+
+
+def test_db_tables_option():
+    from clldfabric.db import _tables_option
+
+    assert not _tables_option([])
+    assert _tables_option(['value'], ['value_pk_seq']) == "-a -t 'value' -t 'value_pk_seq' "
+
+
+def test_db_restore():
+    from clldfabric.config import Config
+    from clldfabric import db
+
+    with patch('clldfabric.db.run', Mock(return_value='pg_dump (PostgreSQL) 9.3.24')):
+        assert db.version() == (9, 3)
+    with patch('clldfabric.db.run', Mock(return_value='psql (PostgreSQL) 12.3 (Ubuntu)')):
+        assert db.version() == (12,)
+
+    app = Config()['wals3']
+    supervisor = Mock()
+    with patch.multiple(
+            'clldfabric.db',
+            version=Mock(return_value=(9, 3)),
+            env=Mock(host='clld2'),
+            sudo=Mock(),
+            supervisor=supervisor,
+            postgres=Mock(),
+            require=Mock(),
+            _psql=Mock(side_effect=ValueError)):
+        # a dump of a newer pg_dump is rejected before the database is dropped:
+        try:
+            db.restore(app, dump_version=(12,))
+            assert False  # pragma: no cover
+        except ValueError:
+            assert not supervisor.called
+        # the app is resumed, even if the restore fails:
+        try:
+            db.restore(app, dump_version=(9, 1))
+            assert False  # pragma: no cover
+        except ValueError:
+            supervisor.assert_called_with(app, 'run')
+
+
+def test_db_diff():
+    from clldfabric.db import diff
+
+    assert diff({'a': (1, 'x'), 'b': (2, 'y')}, {'a': (1, 'x'), 'b': (2, 'z')}) == ['b']
+    try:
+        diff({'a': (1, 'x')}, {'b': (1, 'x')})
+        assert False  # pragma: no cover
+    except ValueError:
+        pass
+
+
+def test_queries():
+    from clldfabric.queries import normalize, aggregate, format_result, comparison_keys
+
+    assert normalize("SELECT * FROM x WHERE pk IN (1, 2,3) AND id = 'it''s'") == \
+        "SELECT * FROM x WHERE pk IN (...) AND id = ?"
+    assert normalize("SELECT * FROM x1 WHERE pk IN ($1, $2) AND v > 1.5e3") == \
+        "SELECT * FROM x1 WHERE pk IN (...) AND v > ?"
+    queries = aggregate([
+        ('10', '50.0', '10', 'SELECT * FROM language WHERE pk = 1'),
+        ('30', '50.0', '30', 'SELECT * FROM language  WHERE pk = 2'),
+        ('1', '100.0', '1', 'SELECT count(*) FROM value'),
+    ])
+    assert len(queries) == 2
+    q = [q for q in queries.values() if q['calls'] == 40][0]
+    assert q['mean_ms'] == 2.5 and q['percent'] == 50
+    result = dict(queries=queries, tables=dict(value=dict(
+        seq_scan=5, seq_tup_read=500, idx_scan=0, rows=100, unused_indexes=['ix'])))
+    assert 'ix' in format_result(result)
+    assert len(list(comparison_keys(result))) == 3
+
+
+def test_preload_libraries():
+    from clldfabric.util import preload_libraries
+
+    assert preload_libraries('') == "shared_preload_libraries = 'pg_stat_statements'"
+    assert preload_libraries("shared_preload_libraries = ''\n"
+                             "shared_preload_libraries = 'auto_explain'  # x") == \
+        "shared_preload_libraries = 'auto_explain, pg_stat_statements'"
+
+
+def test_status_parse():
+    from clldfabric.status import parse, format_table
+
+    res = parse("""\
+wals3|ping|200 0.012
+wals3|supervisor|RUNNING
+wals3|processes|8 1048576
+wals3|db|104857600
+apics|ping|000 0.000
+apics|supervisor|STOPPED
+apics|processes|0 0
+apics|db|
+""", 'harald')
+    assert res[1] == dict(
+        app='wals3', host='harald', ping='ok', latency_ms=12.0, supervisor='RUNNING',
+        workers=7, rss_mb=1024.0, db_mb=100.0)
+    assert res[0]['ping'] == 'FAIL' and res[0]['db_mb'] is None
+    assert 'wals3' in format_table(res)
+
+
+def test_status_fleet():
+    from fabric.exceptions import NetworkError
+    from clldfabric.config import APPS
+    from clldfabric.status import fleet
+
+    def execute(func, apps, hosts=None):
+        return dict((host, NetworkError('timeout')) for host in hosts)
+
+    with patch('clldfabric.status.execute', execute):
+        res = fleet('test')
+    assert len(res) == len(APPS)
+    assert all(s['supervisor'] == 'UNREACHABLE' for s in res)
+
+
+def test_planner():
+    from clldfabric.config import Config
+    from clldfabric.planner import app_profile, loads, place, assignment_diff
+
+    app = Config()['testapp']
+    profile = app_profile(app, 'clld2', dict(rss_mb=800, workers=3), requests=86400)
+    assert profile['memory_mb'] == (app.workers + 1) * 200
+    assert profile['requests_per_s'] == 1
+
+    servers = dict(clld2=dict(memory_mb=4000, cpus=4), harald=dict(memory_mb=4000, cpus=4))
+    apps = [dict(
+        name='app%s' % i, host='clld2', workers=3, memory_mb=800, db_mb=10,
+        requests_per_s=0.1) for i in range(5)]
+    assert loads(apps, servers)['clld2']['overcommitted']
+    placement = place(apps, servers)
+    new = loads(apps, servers, placement=placement)
+    assert not any(load['overcommitted'] for load in new.values())
+    assert len(new['harald']['apps']) == 2
+
+    assert '+test = harald' in assignment_diff({'testapp': 'harald'}, 'test')
+    assert not assignment_diff({}, 'test')
+
+
+def test_ssh_pool():
+    from fabric.network import HostConnectionCache
+    from clldfabric import ssh
+
+    connections = ssh.pool(HostConnectionCache())
+    assert ssh.pool(connections) is connections
+    stats = dict(ssh.STATS)
+    with patch('fabric.network.connect', Mock()):
+        for command in ['stop', 'stop', 'deploy', 'deploy']:
+            with patch.dict('fabric.state.env', command=command):
+                connections['user@clld2']
+    assert ssh.STATS['opened'] == stats['opened'] + 1
+    assert ssh.STATS['reused'] == stats['reused'] + 1
+    assert 'ControlPersist=1h' in ssh.options('1h')
+
+
+def test_loadtest_report():
+    from clldfabric.config import Config
+    from clldfabric.loadtest import base_url, report
+
+    app = Config()['wals3']
+    assert base_url(app) == 'http://localhost:8887'
+    assert base_url(app, 'production') == 'http://wals.info'
+    try:
+        base_url(app, 'test')
+        assert False  # pragma: no cover
+    except ValueError:
+        pass
+    app.test_url = 'http://test.clld.org/wals3/'
+    assert base_url(app, 'test') == 'http://test.clld.org/wals3'
+    res = report([('/', 200, 10.0), ('/', 500, 1.0), ('/x', None, 5.0), ('/x', 200, 20.0)], 2)
+    assert res['errors'] == 2 and res['error_rate'] == 0.5 and res['throughput'] == 2
+    assert res['paths']['/x']['count'] == 1
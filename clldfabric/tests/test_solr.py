@@ -0,0 +1,39 @@
+import shutil
+import tempfile
+
+
+def test_core_profile():
+    from clldfabric.solr import core_profile
+
+    small = core_profile(1000, 512)
+    large = core_profile(5000000, 512)
+    assert small['filter_cache']['size'] > large['filter_cache']['size']
+    assert small['document_cache']['size'] == 1000
+    assert large['hard_commit_ms'] > small['hard_commit_ms']
+    assert core_profile(merge_factor=3)['merge_factor'] == 3
+
+
+def test_solrconfig():
+    from clldfabric.solr import solrconfig, core_profile
+
+    xml = solrconfig('core', core_profile(1000, 1024))
+    assert '{{' not in xml
+    assert '<ramBufferSizeMB>128</ramBufferSizeMB>' in xml
+    assert '/opt/solr/data/core' in xml
+
+
+def test_read_querylog():
+    from clldfabric.solr.replay import read_querylog
+
+    tmp = tempfile.mkdtemp()
+    try:
+        fname = '%s/queries.log' % tmp
+        with open(fname, 'w') as fp:
+            fp.write('q=abc&rows=10\n\n')
+            fp.write('INFO: [core] webapp=/solr path=/select params={q=x&wt=xml} '
+                     'hits=3 status=0 QTime=1\n')
+        queries = read_querylog(fname)
+        assert queries[0] == [('q', 'abc'), ('rows', '10'), ('wt', 'json')]
+        assert queries[1] == [('q', 'x'), ('wt', 'json')]
+    finally:
+        shutil.rmtree(tmp)
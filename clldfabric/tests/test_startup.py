@@ -0,0 +1,47 @@
+"""
+Startup-time benchmark: importing the task module - which is what `fab --list` and every
+task invocation does - must not pull in the heavy parts of the stack.
+"""
+import os
+import sys
+import json
+import subprocess
+
+# Budget for importing clldfabric.tasks and looking up one app, in seconds.
+BUDGET = float(os.environ.get('CLLDFABRIC_STARTUP_BUDGET', '1.0'))
+
+HEAVY = ['fabtools', 'clld', 'pytz', 'pyramid', 'sqlalchemy']
+
+SCRIPT = """
+import sys, json, time
+start = time.time()
+from clldfabric import tasks
+tasks.init('testapp')
+print(json.dumps(dict(
+    duration=time.time() - start,
+    modules=sorted(set(m.split('.')[0] for m in sys.modules)),
+    apps=len(tasks.config.APPS._apps))))
+"""
+
+
+def _startup():
+    out = subprocess.check_output([sys.executable, '-c', SCRIPT])
+    return json.loads(out.decode('utf8').strip().splitlines()[-1])
+
+
+def test_startup():
+    res = _startup()
+    assert not set(HEAVY).intersection(res['modules'])
+    assert res['apps'] == 1
+    assert res['duration'] < BUDGET, res['duration']
+
+
+def test_lazy_config():
+    from clldfabric.config import Config
+
+    apps = Config()
+    assert apps._parser is None
+    assert 'testapp' in apps and 'unknown' not in apps
+    assert apps['testapp'].port == 9999
+    assert list(apps._apps) == ['testapp']
+    assert len(apps) == len(list(apps.values()))
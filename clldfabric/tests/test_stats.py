@@ -0,0 +1,31 @@
+import shutil
+import tempfile
+
+from mock import patch
+
+
+def test_summary():
+    from clldfabric.stats import percentile, summary, histogram
+
+    assert percentile([], 50) is None
+    assert percentile([1, 2, 3, 4], 50) == 2.5
+    res = summary(list(range(101)))
+    assert res['p90'] == 90 and res['mean'] == 50
+    assert dict(histogram([1, 7, 10000], bins=(5, 10)))[None] == 1
+
+
+def test_store():
+    from clldfabric import stats
+
+    tmp = tempfile.mkdtemp()
+    try:
+        with patch('clldfabric.stats.RESULTS_DIR', tmp):
+            assert stats.previous('solr', 'core') is None
+            stats.save('solr', 'core', dict(timestamp='2016-01-01T00:00:00', x=dict(y=2)))
+            old = stats.previous('solr', 'core')
+            comparison = stats.compare(old, dict(x=dict(y=3)), ['x.y', 'z'])
+            assert comparison[0] == ('x.y', 2, 3, 50.0)
+            assert comparison[1][-1] is None
+            assert stats.format_comparison(comparison)
+    finally:
+        shutil.rmtree(tmp)
@@ -1,5 +1,7 @@
 """Deployment utilities for clld apps."""
 # flake8: noqa
+import re
+import sys
 import time
 import json
 from getpass import getpass
@@ -7,21 +9,14 @@ import os
 from datetime import datetime, timedelta
 from importlib import import_module
 import contextlib
+import difflib
+import hashlib
 
-from pytz import timezone, utc
-
-from fabric.api import sudo, run, local, put, env, cd, task, execute, settings
+from fabric.api import sudo, run, local, put, env, cd, task, execute, settings, hide
 from fabric.contrib.console import confirm
-from fabric.contrib.files import exists
-from fabtools import require
-from fabtools.files import upload_template
-from fabtools.python import virtualenv
-from fabtools import service
-from fabtools import postgres
+from fabric.contrib.files import exists, append
 from clldutils.path import Path
 
-from clld.scripts.util import data_file
-
 # we prevent the tasks defined here from showing up in fab --list, because we only
 # want the wrapped version imported from clldfabric.tasks to be listed.
 __all__ = []
@@ -31,6 +26,43 @@ TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
 env.use_ssh_config = True
 
 
+class _LazyModule(object):
+    """Proxy for a module which is only imported when one of its attributes is accessed.
+
+    fabtools imports all its submodules and clld pulls in the whole app stack, so we
+    defer these imports until a task actually needs them, to keep `fab --list` fast.
+    """
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            __import__(self.__name)
+            self.__module = sys.modules[self.__name]
+        return getattr(self.__module, attr)
+
+
+require = _LazyModule('fabtools.require')
+service = _LazyModule('fabtools.service')
+postgres = _LazyModule('fabtools.postgres')
+
+
+def upload_template(*args, **kw):
+    from fabtools.files import upload_template as _upload_template
+    return _upload_template(*args, **kw)
+
+
+def virtualenv(*args, **kw):
+    from fabtools.python import virtualenv as _virtualenv
+    return _virtualenv(*args, **kw)
+
+
+def data_file(*args, **kw):
+    from clld.scripts.util import data_file as _data_file
+    return _data_file(*args, **kw)
+
+
 def get_input(prompt):
     return raw_input(prompt)
 
@@ -48,12 +80,49 @@ def working_directory(path):
         os.chdir(prev_cwd)
 
 
+def render_template(template, context=None):
+    from jinja2 import Environment, FileSystemLoader
+
+    jenv = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    return jenv.get_template(template).render(**(context or {}))
+
+
+def remote_md5(path):
+    """md5 checksum of a remote file or None, if the file does not exist.
+    """
+    with hide('everything'):
+        res = sudo('md5sum %s 2>/dev/null || true' % path)
+    if res.strip():
+        return res.split()[0]
+
+
+def show_diff(path, content):
+    with hide('everything'):
+        old = sudo('cat %s 2>/dev/null || true' % path)
+    diff = list(difflib.unified_diff(
+        old.splitlines(), content.splitlines(), '%s (remote)' % path, '%s (new)' % path, lineterm=''))
+    print('\n'.join(diff) if diff else '--> %s: unchanged' % path)
+
+
 def upload_template_as_root(dest, template, context=None, mode=None, owner='root'):
+    """upload a rendered template, unless the remote file has the same content already.
+
+    With `env.plan` set, only a diff of the changes is printed.
+
+    :return: True if the remote file was (or would be) changed.
+    """
+    content = render_template(template, context)
+    if remote_md5(dest) == hashlib.md5(content.encode('utf8')).hexdigest():
+        return False
+    if env.get('plan'):
+        show_diff(dest, content)
+        return True
     if mode is not None:
         mode = int(mode, 8)
     upload_template(template, str(dest), context, use_jinja=True,
                     template_dir=TEMPLATE_DIR, use_sudo=True, backup=False,
                     mode=mode, chown=True, user=owner)
+    return True
 
 
 def create_file_as_root(path, content, **kw):
@@ -63,7 +132,10 @@ def create_file_as_root(path, content, **kw):
 
 
 def get_template_variables(app, monitor_mode=False, with_blog=False):
-    if monitor_mode and not os.environ.get('NEWRELIC_API_KEY'):
+    from clldfabric.metrics import PORT
+
+    statsd = getattr(app, 'statsd', False)
+    if monitor_mode and not statsd and not os.environ.get('NEWRELIC_API_KEY'):
         print('--> Warning: no newrelic api key found in environment')  # pragma: no cover
 
     res = dict(
@@ -73,6 +145,8 @@ def get_template_variables(app, monitor_mode=False, with_blog=False):
         gunicorn=app.bin('gunicorn_paster'),
         newrelic=app.bin('newrelic-admin'),
         monitor_mode=monitor_mode,
+        statsd=statsd,
+        statsd_port=PORT,
         auth='',
         bloghost='',
         bloguser='',
@@ -94,17 +168,24 @@ def get_template_variables(app, monitor_mode=False, with_blog=False):
 
 
 @task
-def supervisor(app, command, template_variables=None):
+def supervisor(app, command, template_variables=None, restart=True):
     """
     .. seealso: http://serverfault.com/a/479754
+
+    :param restart: If False, the app is only restarted when its supervisor config \
+    changed - or when it is not running, e.g. because it crashed.
     """
     template_variables = template_variables or get_template_variables(app)
     template_variables['PAUSE'] = {'pause': True, 'run': False}[command]
-    upload_template_as_root(
+    changed = upload_template_as_root(
         app.supervisor, 'supervisor.conf', template_variables, mode='644')
     if command == 'run':
-        sudo('supervisorctl reread')
-        sudo('supervisorctl update %s' % app.name)
+        if changed:
+            sudo('supervisorctl reread')
+            sudo('supervisorctl update %s' % app.name)
+        elif not restart and 'RUNNING' in sudo(
+                'supervisorctl status %s' % app.name, warn_only=True).split():
+            return
         sudo('supervisorctl restart %s' % app.name)
     else:
         sudo('supervisorctl stop %s' % app.name)
@@ -144,6 +225,8 @@ def uninstall(app):  # pragma: no cover
 def maintenance(app, hours=2, template_variables=None):
     """turn maintenance mode on|off
     """
+    from pytz import timezone, utc
+
     template_variables = template_variables or get_template_variables(app)
     ts = utc.localize(datetime.utcnow() + timedelta(hours=hours))
     ts = ts.astimezone(timezone('Europe/Berlin')).strftime('%Y-%m-%d %H:%M %Z%z')
@@ -153,6 +236,42 @@ def maintenance(app, hours=2, template_variables=None):
         app.www.joinpath('503.html'), '503.html', template_variables)
 
 
+@task
+def snapshot(app, concurrency=4, max_pages=10000):
+    """crawl the app's public pages into a static snapshot, served by nginx while the app
+    is down.
+
+    If most pages can not be fetched - e.g. because the app is down already - the
+    previous snapshot is kept.
+
+    :return: dict with number of pages, size in bytes and crawl time in seconds.
+    """
+    script = app.home.joinpath('snapshot.py')
+    require.files.file(
+        str(script), source=os.path.join(TEMPLATE_DIR, 'snapshot.py'), use_sudo=True)
+    require.files.directory(str(app.www), use_sudo=True)
+    with settings(warn_only=True):
+        out = sudo('%s %s http://localhost:%s %s %s --concurrency %s --max-pages %s' % (
+            app.bin('python'), script, app.port, app.domain, app.snapshot,
+            concurrency, max_pages))
+    res = json.loads(out.splitlines()[-1])
+    if out.failed:
+        print('--> Warning: crawl failed for %s of %s pages, keeping previous snapshot' % (
+            res['failed'], res['failed'] + res['pages']))
+    else:
+        print('--> snapshot of %s pages (%.1f MB) crawled in %.1fs' % (
+            res['pages'], res['bytes'] / 1048576.0, res['seconds']))
+    return res
+
+
+def _auth_config(app):
+    return """\
+        proxy_set_header Authorization $http_authorization;
+        proxy_pass_header  Authorization;
+        auth_basic "%s";
+        auth_basic_user_file %s;""" % (app.name, app.nginx_htpasswd)
+
+
 def http_auth(app):
     pwds = {
         app.name: getpass(prompt='HTTP Basic Auth password for user %s: ' % app.name),
@@ -167,11 +286,7 @@ def http_auth(app):
             opts += 'c'
         sudo('htpasswd -%s %s %s %s' % (opts, app.nginx_htpasswd, pair[0], pair[1]))
 
-    return bool(pwds[app.name]), """\
-        proxy_set_header Authorization $http_authorization;
-        proxy_pass_header  Authorization;
-        auth_basic "%s";
-        auth_basic_user_file %s;""" % (app.name, app.nginx_htpasswd)
+    return bool(pwds[app.name]), _auth_config(app)
 
 
 @task
@@ -213,6 +328,50 @@ def copy_downloads(app, pattern='*'):
     require.files.directory(dl_dir, use_sudo=True, mode="755")
 
 
+def preload_libraries(conf_lines):
+    """merge pg_stat_statements into the shared_preload_libraries setting.
+
+    :param conf_lines: the active (i.e. not commented) setting lines of postgresql.conf.
+    :return: the new setting line.
+    """
+    libs = []
+    for line in conf_lines.splitlines():
+        # the last setting wins.
+        match = re.search(r"=\s*'([^']*)'", line)
+        if match:
+            libs = [lib.strip() for lib in match.group(1).split(',') if lib.strip()]
+    if 'pg_stat_statements' not in libs:
+        libs.append('pg_stat_statements')
+    return "shared_preload_libraries = '%s'" % ', '.join(libs)
+
+
+def require_pg_stat_statements(pg_version):
+    """enable query statistics for all databases on the host.
+
+    The extension is created in the postgres database, so that it survives the
+    recreation of app databases; the statistics are kept per database anyway.
+    """
+    conf = '/etc/postgresql/%s/main/postgresql.conf' % pg_version
+    active = sudo(
+        "grep '^[[:space:]]*shared_preload_libraries' %s || true" % conf, quiet=True).strip()
+    if 'pg_stat_statements' not in active:
+        require.deb.packages(['postgresql-contrib'])
+        setting = preload_libraries(active)
+        if active:
+            # fabric's sed would escape the quotes of the setting within a single-quoted
+            # string, thus we quote the expression with double quotes.
+            sudo('sed -i -E "s/^[[:space:]]*shared_preload_libraries.*/%s/" %s' % (
+                setting, conf))
+        else:
+            append(conf, setting, use_sudo=True)
+        # loading a library requires a restart of the server, interrupting all apps.
+        if confirm('Restart PostgreSQL to load pg_stat_statements?', default=False):
+            service.restart('postgresql')
+        else:
+            print('--> pg_stat_statements will be loaded when PostgreSQL is restarted')
+    sudo('sudo -u postgres psql -c "CREATE EXTENSION IF NOT EXISTS pg_stat_statements;"')
+
+
 def init_pg_collkey(app):
     require.files.file(
         '/tmp/collkey_icu.sql',
@@ -221,27 +380,109 @@ def init_pg_collkey(app):
     sudo('sudo -u postgres psql -f /tmp/collkey_icu.sql -d {0.name}'.format(app))
 
 
-@task
-def deploy(app, environment, with_alembic=False, with_blog=False, with_files=True):
-    with settings(warn_only=True):
-        lsb_release = run('lsb_release -a')
-    for codename in ['trusty', 'precise']:
-        if codename in lsb_release:
-            lsb_release = codename
-            break
-    else:
-        if lsb_release != '{"status": "ok"}':
-            # if this were the case, we'd be in a test!
-            raise ValueError('unsupported platform: %s' % lsb_release)
-
+def _deploy_template_variables(app, environment, with_blog=False):
     if environment == 'test' and app.workers > 3:
         app.workers = 3
 
-    template_variables = get_template_variables(
+    return get_template_variables(
         app,
         monitor_mode='true' if environment == 'production' else 'false',
         with_blog=with_blog)
 
+
+def _clld_dir(app):
+    with virtualenv(str(app.venv)):
+        res = sudo('python -c "import clld; print(clld.__file__)"')
+    assert res.startswith('/usr/venvs') and '__init__.py' in res
+    res = '/'.join(res.split('/')[:-1])
+    prefix = str(app.releases_dir) + '/'
+    if getattr(app, 'releases', False) and res.startswith(prefix):
+        # refer to the active release, to serve the matching static files after a switch.
+        res = '%s/%s' % (app.venv, res[len(prefix):].split('/', 1)[1])
+    return res
+
+
+def _nginx_configs(app, environment, template_variables):
+    """
+    :return: list of triples (path, template, True if nginx must be reloaded on change).
+    """
+    if environment == 'test':
+        template_variables['SITE'] = False
+        return [
+            ('/etc/nginx/sites-available/default', 'nginx-default.conf', True),
+            (app.nginx_location, 'nginx-app.conf', True)]
+    if environment == 'production':
+        template_variables['SITE'] = True
+        return [
+            (app.nginx_site, 'nginx-app.conf', True),
+            ('/etc/logrotate.d/{0}'.format(app.name), 'logrotate.conf', False)]
+    return []
+
+
+def _nginx_fingerprint(app, environment, template_variables):
+    """checksums of the rendered nginx config files.
+    """
+    return [
+        hashlib.md5(render_template(template, template_variables).encode('utf8')).hexdigest()
+        for _, template, _ in _nginx_configs(app, environment, template_variables)]
+
+
+def _upload_nginx_config(app, environment, template_variables):
+    """
+    :return: True if nginx must be reloaded.
+    """
+    changed = []
+    for path, template, reload in _nginx_configs(app, environment, template_variables):
+        if upload_template_as_root(path, template, template_variables) and reload:
+            changed.append(path)
+    return bool(changed)
+
+
+def _upload_app_config(app, environment, template_variables):
+    """
+    :return: True if the app must be restarted.
+    """
+    template_variables['TEST'] = {'test': True, 'production': False}[environment]
+    # We only set add a setting clld.files, if the corresponding directory exists;
+    # otherwise the app would throw an error on startup.
+    template_variables['files'] = False
+    if exists(app.www.joinpath('files')):
+        template_variables['files'] = app.www.joinpath('files')
+    changed = [upload_template_as_root(app.config, 'config.ini', template_variables)]
+    if not getattr(app, 'statsd', False):
+        changed.append(upload_template_as_root(
+            app.newrelic_config, 'newrelic.ini', template_variables))
+    return any(changed)
+
+
+@task
+def plan(app, environment, with_blog=False):
+    """show the changes a deploy would make to the config files of the app.
+    """
+    template_variables = _deploy_template_variables(app, environment, with_blog)
+    template_variables['clld_dir'] = _clld_dir(app)
+    with hide('everything'):
+        restricted = sudo("grep -q '^%s:' %s && echo restricted || true" % (
+            app.name, app.nginx_htpasswd)).strip() == 'restricted'
+    auth = _auth_config(app)
+    if restricted:
+        template_variables['auth'] = auth
+    template_variables['admin_auth'] = auth
+
+    with settings(plan=True):
+        if _upload_nginx_config(app, environment, template_variables):
+            print('--> nginx would be reloaded')
+        restart = _upload_app_config(app, environment, template_variables)
+        template_variables['PAUSE'] = False
+        if upload_template_as_root(app.supervisor, 'supervisor.conf', template_variables):
+            restart = True
+    if restart:
+        print('--> %s would be restarted' % app.name)
+
+
+def _require_system(app, lsb_release):
+    """require the system packages, user, database and directories of the app.
+    """
     require.users.user(app.name, shell='/bin/bash')
     require.postfix.server(env['host'])
     require.postgres.server()
@@ -249,6 +490,12 @@ def deploy(app, environment, with_alembic=False, with_blog=False, with_files=Tru
     require.postgres.user(app.name, app.name)
     require.postgres.database(app.name, app.name)
     require.files.directory(str(app.venv), use_sudo=True)
+    pg_version = '9.1' if lsb_release == 'precise' else '9.3'
+    require_pg_stat_statements(pg_version)
+    if getattr(app, 'statsd', False):
+        from clldfabric import metrics
+
+        metrics.require_aggregator()
 
     if getattr(app, 'pg_unaccent', False):
         require.deb.packages(['postgresql-contrib'])
@@ -256,9 +503,7 @@ def deploy(app, environment, with_alembic=False, with_blog=False, with_files=Tru
             'CREATE EXTENSION IF NOT EXISTS unaccent WITH SCHEMA public;',
             app))    
 
-    with_pg_collkey = getattr(app, 'pg_collkey', False)
-    if with_pg_collkey:
-        pg_version = '9.1' if lsb_release == 'precise' else '9.3'
+    if getattr(app, 'pg_collkey', False):
         if not exists('/usr/lib/postgresql/%s/lib/collkey_icu.so' % pg_version):
             require.deb.packages(['postgresql-server-dev-%s' % pg_version, 'libicu-dev'])
             upload_template_as_root(
@@ -273,13 +518,15 @@ def deploy(app, environment, with_alembic=False, with_blog=False, with_files=Tru
                 sudo('make install')
         init_pg_collkey(app)
 
+    with_releases = getattr(app, 'releases', False)
     if lsb_release == 'precise':
         require.deb.package('python-dev')
-        require.python.virtualenv(str(app.venv), use_sudo=True)
+        if not with_releases:
+            require.python.virtualenv(str(app.venv), use_sudo=True)
     else:
         require.deb.package('python3-dev')
         require.deb.package('python-virtualenv')
-        if not exists(str(app.venv.joinpath('bin'))):
+        if not with_releases and not exists(str(app.venv.joinpath('bin'))):
             sudo('virtualenv -q --python=python3 %s' % app.venv)
 
     require.files.directory(str(app.logs), use_sudo=True)
@@ -288,48 +535,51 @@ def deploy(app, environment, with_alembic=False, with_blog=False, with_files=Tru
         with cd(str(app.home)):
             sudo('sudo -u {0} git clone https://github.com/clld/{0}-pages.git'.format(app.name))
 
-    with virtualenv(str(app.venv)):
-        require.python.pip('6.0.6')
-        sp = env['sudo_prefix']
-        env['sudo_prefix'] += ' -H'  # set HOME for pip log/cache
-        require.python.packages(app.require_pip, use_sudo=True)
-        for name in [app.name] + getattr(app, 'dependencies', []):
-            pkg = '-e git+git://github.com/clld/%s.git#egg=%s' % (name, name)
-            require.python.package(pkg, use_sudo=True)
-        env['sudo_prefix'] = sp
-        sudo('webassets -m %s.assets build' % app.name)
-        res = sudo('python -c "import clld; print(clld.__file__)"')
-        assert res.startswith('/usr/venvs') and '__init__.py' in res
-        template_variables['clld_dir'] = '/'.join(res.split('/')[:-1])
-
-    require_bibutils(app)
-
-    #
-    # configure nginx:
-    #
-    require.files.directory(
-        os.path.dirname(str(app.nginx_location)),
-        owner='root', group='root', use_sudo=True)
 
-    restricted, auth = http_auth(app)
-    if restricted:
-        template_variables['auth'] = auth
-    template_variables['admin_auth'] = auth
+def _install(app, lsb_release, wheelhouse=None):
+    """install the app and build its assets.
 
-    if environment == 'test':
-        upload_template_as_root('/etc/nginx/sites-available/default', 'nginx-default.conf')
-        template_variables['SITE'] = False
-        upload_template_as_root(
-            app.nginx_location, 'nginx-app.conf', template_variables)
-    elif environment == 'production':
-        template_variables['SITE'] = True
-        upload_template_as_root(app.nginx_site, 'nginx-app.conf', template_variables)
-        upload_template_as_root(
-            '/etc/logrotate.d/{0}'.format(app.name), 'logrotate.conf', template_variables)
+    :return: True if the app must be restarted.
+    """
+    sp = env['sudo_prefix']
+    env['sudo_prefix'] += ' -H'  # set HOME for pip log/cache
+    if getattr(app, 'releases', False):
+        from clldfabric import release
 
+        # the release contains the virtualenv with the compiled assets.
+        restart = release.require_release(app, lsb_release)
+    else:
+        with virtualenv(str(app.venv)):
+            installed = sudo('pip freeze')
+            shipped = False
+            if wheelhouse:
+                from clldfabric import wheelhouse as _wheelhouse
+
+                # pip is upgraded from the wheelhouse, rather than with get-pip.
+                shipped = _wheelhouse.ship(app, wheelhouse)
+                _wheelhouse.install(app)
+            else:
+                require.python.pip('6.0.6')
+                require.python.packages(app.require_pip, use_sudo=True)
+                for name in [app.name] + getattr(app, 'dependencies', []):
+                    pkg = '-e git+git://github.com/clld/%s.git#egg=%s' % (name, name)
+                    require.python.package(pkg, use_sudo=True)
+            # Since the app and its clld dependencies are installed from git, the output
+            # of pip freeze also changes when new code was pulled.
+            restart = shipped or sudo('pip freeze') != installed
+            sudo('webassets -m %s.assets build' % app.name)
+    env['sudo_prefix'] = sp
+    return restart
+
+
+def _configure_nginx(app, environment, template_variables):
+    nginx_changed = _upload_nginx_config(app, environment, template_variables)
     maintenance(app, hours=app.deploy_duration, template_variables=template_variables)
-    service.reload('nginx')
+    if nginx_changed:
+        service.reload('nginx')
 
+
+def _copy_files(app, with_files):
     #
     # TODO: replace with initialization of db from data repos!
     #
@@ -337,6 +587,19 @@ def deploy(app, environment, with_alembic=False, with_blog=False, with_files=Tru
         if confirm('Copy files?', default=False):
             execute(copy_files, app)
 
+
+def _update_database(app, environment, with_alembic, template_variables):
+    """recreate or upgrade the app's database.
+
+    :return: True if the app was paused.
+    """
+    def pause():
+        if environment == 'production' \
+                and confirm('Crawl static snapshot to serve meanwhile?', default=True):
+            snapshot(app)
+        supervisor(app, 'pause', template_variables)
+
+    restart = False
     if not with_alembic and confirm('Recreate database?', default=False):
         db_name = get_input('from db [{0.name}]: '.format(app))
         local('pg_dump -x -O -f /tmp/{0.name}.sql {1}'.format(app, db_name or app.name))
@@ -345,14 +608,15 @@ def deploy(app, environment, with_alembic=False, with_blog=False, with_files=Tru
             '/tmp/{0.name}.sql.gz'.format(app),
             source="/tmp/{0.name}.sql.gz".format(app))
         sudo('gunzip -f /tmp/{0.name}.sql.gz'.format(app))
-        supervisor(app, 'pause', template_variables)
+        pause()
+        restart = True
 
         if postgres.database_exists(app.name):
             with cd('/var/lib/postgresql'):
                 sudo('sudo -u postgres dropdb %s' % app.name)
 
             require.postgres.database(app.name, app.name)
-            if with_pg_collkey:
+            if getattr(app, 'pg_collkey', False):
                 init_pg_collkey(app)
 
         sudo('sudo -u {0.name} psql -f /tmp/{0.name}.sql -d {0.name}'.format(app))
@@ -361,7 +625,8 @@ def deploy(app, environment, with_alembic=False, with_blog=False, with_files=Tru
             if confirm('Upgrade database?', default=False):
                 # Note: stopping the app is not strictly necessary, because the alembic
                 # revisions run in separate transactions!
-                supervisor(app, 'pause', template_variables)
+                pause()
+                restart = True
                 with virtualenv(str(app.venv)):
                     with cd(str(app.src)):
                         sudo('sudo -u {0.name} {1} -n production upgrade head'.format(
@@ -372,21 +637,118 @@ def deploy(app, environment, with_alembic=False, with_blog=False, with_files=Tru
                         sudo('sudo -u postgres vacuumdb -f -z -d %s' % app.name)
                     else:
                         sudo('sudo -u postgres vacuumdb -z -d %s' % app.name)
+    return restart
 
-    template_variables['TEST'] = {'test': True, 'production': False}[environment]
-    # We only set add a setting clld.files, if the corresponding directory exists;
-    # otherwise the app would throw an error on startup.
-    template_variables['files'] = False
-    if exists(app.www.joinpath('files')):
-        template_variables['files'] = app.www.joinpath('files')
-    upload_template_as_root(app.config, 'config.ini', template_variables)
-    upload_template_as_root(app.newrelic_config, 'newrelic.ini', template_variables)
 
-    supervisor(app, 'run', template_variables)
+def _revisions(app):
+    """git revisions of the app and its clld dependencies, or None if the lookup failed.
+    """
+    from clldfabric import release
+
+    with settings(warn_only=True):
+        try:
+            return release.revisions(app)
+        except IndexError:
+            print('--> Warning: git revisions of %s could not be looked up' % app.name)
+
+
+def _file_fingerprint(fname):
+    if fname and os.path.exists(fname):
+        return fname, os.path.getsize(fname), os.path.getmtime(fname)
+    return fname
+
+
+@task
+def deploy(app, environment, with_alembic=False, with_blog=False, with_files=True,
+           wheelhouse=None, resume=True):
+    """
+    The deploy runs as sequence of steps, recorded in a journal (see clldfabric.journal),
+    so that a failed deploy can be resumed.
+
+    :param wheelhouse: If True, install the app from a local wheelhouse for the host's \
+    python version (see clldfabric.wheelhouse) - which is (re)built if it is missing or \
+    stale - instead of from PyPI and GitHub.
+    :param resume: If False, all steps are run, even if a previous deploy failed late.
+    """
+    from clldfabric.journal import Journal
+
+    with settings(warn_only=True):
+        lsb_release = run('lsb_release -a')
+    for codename in ['trusty', 'precise']:
+        if codename in lsb_release:
+            lsb_release = codename
+            break
+    else:
+        if lsb_release != '{"status": "ok"}':
+            # if this were the case, we'd be in a test!
+            raise ValueError('unsupported platform: %s' % lsb_release)
+
+    if wheelhouse:
+        from clldfabric import wheelhouse as _wheelhouse
+
+        wheelhouse = _wheelhouse.require_tarball(
+            app, _wheelhouse.PYTHON_VERSIONS[lsb_release])
+
+    journal = Journal(env['host'], app, resume=resume)
+    template_variables = _deploy_template_variables(app, environment, with_blog)
+
+    journal.step(
+        'system',
+        [lsb_release, app.require_deb, [
+            getattr(app, opt, False)
+            for opt in ['pg_unaccent', 'pg_collkey', 'releases', '_pages', 'statsd']]],
+        _require_system, app, lsb_release)
+    restart = journal.step(
+        'install',
+        [lsb_release,
+         app.require_pip,
+         getattr(app, 'dependencies', []),
+         getattr(app, 'releases', False),
+         _file_fingerprint(wheelhouse),
+         # the app and its clld dependencies are installed from git - a wheelhouse is
+         # rebuilt when they changed, so its fingerprint covers the revisions.
+         None if wheelhouse else _revisions(app)],
+        _install, app, lsb_release, wheelhouse=wheelhouse)
+    template_variables['clld_dir'] = _clld_dir(app)
+
+    require_bibutils(app)
+
+    #
+    # configure nginx:
+    #
+    require.files.directory(
+        os.path.dirname(str(app.nginx_location)),
+        owner='root', group='root', use_sudo=True)
+
+    restricted, auth = http_auth(app)
+    if restricted:
+        template_variables['auth'] = auth
+    template_variables['admin_auth'] = auth
+
+    journal.step(
+        'nginx',
+        [environment,
+         template_variables['clld_dir'],
+         restricted,
+         app.deploy_duration,
+         _nginx_fingerprint(app, environment, template_variables)],
+        _configure_nginx, app, environment, template_variables)
+    journal.step('files', [with_files], _copy_files, app, with_files)
+    if journal.step(
+            'database',
+            [environment, with_alembic],
+            _update_database, app, environment, with_alembic, template_variables):
+        restart = True
+
+    if _upload_app_config(app, environment, template_variables):
+        restart = True
+    # supervisor restarts the app anyway, if its supervisor config changed.
+    supervisor(app, 'run', template_variables, restart=restart)
 
     time.sleep(5)
     res = run('curl http://localhost:%s/_ping' % app.port)
     assert json.loads(res)['status'] == 'ok'
+    journal.complete()
 
 
 @task
@@ -420,21 +782,50 @@ def run_script(app, script_name, *args):  # pragma: no cover
 
 
 @task
-def create_downloads(app):  # pragma: no cover
+def create_downloads(app, processes=0, force=False, serial=False):  # pragma: no cover
+    """
+    :param processes: Number of downloads to create in parallel, defaults to the number \
+    of cores.
+    :param force: Recreate downloads even if the database did not change.
+    :param serial: Run the app's own create_downloads script instead.
+    """
     dl_dir = app.src.joinpath(app.name, 'static', 'download')
     require.files.directory(dl_dir, use_sudo=True, mode="777")
-    # run the script to create the exports from the database as glottolog3 user
-    run_script(app, 'create_downloads')
+    if serial:
+        # run the script to create the exports from the database as glottolog3 user
+        run_script(app, 'create_downloads')
+    else:
+        script = app.home.joinpath('downloads.py')
+        require.files.file(
+            str(script), source=os.path.join(TEMPLATE_DIR, 'downloads.py'), use_sudo=True)
+        with cd(str(app.home)):
+            sudo(
+                '%s %s %s#%s --processes %s%s' % (
+                    app.bin('python'),
+                    script,
+                    os.path.basename(str(app.config)),
+                    app.name,
+                    processes,
+                    ' --force' if force else ''),
+                user=app.name)
     require.files.directory(dl_dir, use_sudo=True, mode="755")
 
 
-def bootstrap(nr='y'):  # pragma: no cover
+def bootstrap(nr='y', statsd='n'):  # pragma: no cover
+    """
+    :param statsd: If 'y', run the statsd aggregator (see clldfabric.metrics) instead of \
+    the newrelic server monitor.
+    """
     for pkg in 'vim tree nginx open-vm-tools'.split():
         require.deb.package(pkg)
 
     sudo('/etc/init.d/nginx start')
 
-    if nr == 'y':
+    if statsd == 'y':
+        from clldfabric import metrics
+
+        metrics.require_aggregator()
+    elif nr == 'y':
         for cmd in [
             'wget -O /etc/apt/sources.list.d/newrelic.list http://download.newrelic.com/debian/newrelic.list',
             'apt-key adv --keyserver hkp://subkeys.pgp.net --recv-keys 548C16BF',
@@ -13,11 +13,10 @@ deploy with varnish:
 - /etc/init.d/nginx reload
 """
 from fabric.contrib.files import append, exists
-from fabtools import require
-from fabtools import service
 
 from clldfabric.util import (
     create_file_as_root, upload_template_as_root, get_template_variables, http_auth,
+    require, service,
 )
 from clldfabric.config import App
 
@@ -0,0 +1,203 @@
+"""
+Offline provisioning of app virtualenvs from a wheelhouse:
+
+- the sources of the app and its clld dependencies are cloned locally,
+- wheels for all their requirements are built locally, by pip in a virtualenv with the
+  target python version - so that environment markers and `Requires-Python` are
+  evaluated for the target - and platform specific wheels are replaced with manylinux wheels for the target python version, if available, or with
+  source distributions, which are then built on the server,
+- sources and wheels are shipped to the server as one tarball,
+- pip in the virtualenv is upgraded from the wheelhouse - pip supports manylinux wheels
+  since 8.1 - and the virtualenv is populated with `pip install --no-index`.
+
+The git revisions the wheelhouse was built from are recorded, so that a stale
+wheelhouse is rebuilt before it is deployed.
+
+Thus, compiling psycopg2 or lxml and cloning repositories happens only once, and
+deploys do not depend on the servers reaching PyPI or GitHub.
+"""
+import os
+import re
+import json
+import shutil
+import hashlib
+
+from fabric.api import sudo, local, settings
+from fabric.contrib.files import exists
+
+from clldfabric.util import require, virtualenv, remote_md5
+from clldfabric import release
+
+WHEELHOUSE_DIR = os.environ.get(
+    'CLLDFABRIC_WHEELHOUSE', os.path.join(os.path.expanduser('~'), '.clldfabric', 'wheelhouse'))
+PLATFORM = 'manylinux1_x86_64'
+# the first pip version supporting manylinux wheels, and the last supporting python 3.4
+PIP = 'pip>=8.1,<19'
+
+# python versions of the virtualenvs per ubuntu release, see util.deploy
+PYTHON_VERSIONS = {'precise': '2.7', 'trusty': '3.4'}
+PYTHON_VERSION = PYTHON_VERSIONS['trusty']
+
+
+def interpreter(python_version):
+    """local python interpreter of the target version, used to build the wheels.
+
+    Defaults to `pythonX.Y` on the PATH and can be set with the environment variable
+    CLLDFABRIC_PYTHONXY, e.g. CLLDFABRIC_PYTHON34.
+    """
+    return os.environ.get(
+        'CLLDFABRIC_PYTHON%s' % python_version.replace('.', ''),
+        'python%s' % python_version)
+
+WHEEL_PATTERN = re.compile(
+    r'(?P<name>[^-]+)-(?P<version>[^-]+)-.+-(?P<abi>[^-]+)-(?P<platform>[^-]+)\.whl$')
+
+
+def packages(app):
+    """names of the app and its clld dependencies, which are installed from source.
+    """
+    return [app.name] + getattr(app, 'dependencies', [])
+
+
+def local_dir(app, python_version):
+    return os.path.join(WHEELHOUSE_DIR, app.name, 'py%s' % python_version)
+
+
+def tarball(app, python_version):
+    return os.path.join(local_dir(app, python_version), 'wheelhouse.tgz')
+
+
+def manifest(app, python_version):
+    """path of the JSON file recording what the wheelhouse was built from.
+    """
+    return os.path.join(local_dir(app, python_version), 'manifest.json')
+
+
+def _spec(app, revisions):
+    return dict(revisions=revisions, require_pip=sorted(app.require_pip))
+
+
+def _download(wheels, python_version, spec, binary=True):
+    with settings(warn_only=True):
+        return local(
+            'pip download -q --no-deps {0} --dest {1} "{2}"'.format(
+                '--only-binary=:all: --platform {0} --python-version {1} '
+                '--implementation cp'.format(PLATFORM, python_version.replace('.', ''))
+                if binary else '--no-binary=:all:',
+                wheels,
+                spec),
+            capture=True)
+
+
+def _retarget(wheels, python_version):
+    """replace platform specific wheels built for the local machine with wheels for the
+    target platform - or with source distributions.
+    """
+    for fname in sorted(os.listdir(wheels)):
+        match = WHEEL_PATTERN.match(fname)
+        if not match or match.group('platform') == 'any':
+            continue
+        spec = '%s==%s' % (match.group('name'), match.group('version'))
+        if _download(wheels, python_version, spec).failed:
+            # the server builds the package from source, when installing it.
+            if _download(wheels, python_version, spec, binary=False).failed:
+                raise ValueError(  # pragma: no cover
+                    'neither %s wheel nor sdist for %s' % (PLATFORM, spec))
+        os.remove(os.path.join(wheels, fname))
+
+
+def build(app, python_version=PYTHON_VERSION):
+    """build the wheelhouse tarball for app locally.
+
+    :return: path of the tarball.
+    """
+    d = local_dir(app, python_version)
+    src, wheels, venv = [os.path.join(d, n) for n in ['src', 'wheels', 'venv']]
+    # wheels of a previous build may be outdated or no longer required.
+    if os.path.exists(wheels):
+        shutil.rmtree(wheels)
+    os.makedirs(wheels)
+    if not os.path.exists(src):
+        os.makedirs(src)
+    if not os.path.exists(venv):
+        local('virtualenv -q --python=%s %s' % (interpreter(python_version), venv))
+    pip = os.path.join(venv, 'bin', 'pip')
+    local('%s install -q -U "%s" wheel' % (pip, PIP))
+
+    revisions = {}
+    for name in packages(app):
+        clone = os.path.join(src, name)
+        if os.path.exists(clone):
+            local('git -C %s pull -q' % clone)
+        else:
+            local('git clone -q https://github.com/clld/%s.git %s' % (name, clone))
+        revisions[name] = local('git -C %s rev-parse HEAD' % clone, capture=True).strip()
+
+    local('%s wheel -q --wheel-dir %s %s %s' % (
+        pip,
+        wheels,
+        ' '.join("'%s'" % req for req in app.require_pip),
+        ' '.join(os.path.join(src, name) for name in packages(app))))
+    _retarget(wheels, python_version)
+    if _download(wheels, python_version, PIP).failed:
+        raise ValueError('failed to download %s' % PIP)  # pragma: no cover
+
+    res = tarball(app, python_version)
+    local('tar -C %s --exclude=.git -czf %s src wheels' % (d, res))
+    with open(manifest(app, python_version), 'w') as fp:
+        json.dump(_spec(app, revisions), fp, indent=2, sort_keys=True)
+    return res
+
+
+def is_stale(app, python_version, revisions):
+    """whether the wheelhouse does not exist or was built from other revisions.
+    """
+    if not os.path.exists(tarball(app, python_version)) \
+            or not os.path.exists(manifest(app, python_version)):
+        return True
+    with open(manifest(app, python_version)) as fp:
+        return json.load(fp) != _spec(app, revisions)
+
+
+def require_tarball(app, python_version):
+    """build the wheelhouse tarball, unless an up-to-date one exists.
+
+    :return: path of the tarball.
+    """
+    if is_stale(app, python_version, release.revisions(app)):
+        return build(app, python_version)
+    return tarball(app, python_version)
+
+
+def ship(app, tarball):
+    """upload a wheelhouse tarball and unpack it in app.wheelhouse.
+
+    :return: True if the tarball changed - i.e. the app must be restarted, since pip \
+    freeze doesn't reflect code changes of editable installs without .git.
+    """
+    remote = '/tmp/%s-wheelhouse.tgz' % app.name
+    with open(tarball, 'rb') as fp:
+        changed = remote_md5(remote) != hashlib.md5(fp.read()).hexdigest()
+    # require.files.file only uploads the tarball if its checksum changed.
+    require.files.file(remote, source=tarball, use_sudo=True)
+    if exists(str(app.wheelhouse)):
+        sudo('rm -rf %s' % app.wheelhouse)
+    require.files.directory(str(app.wheelhouse), use_sudo=True)
+    sudo('tar -C %s -xzf %s' % (app.wheelhouse, remote))
+    return changed
+
+
+def install(app):
+    """install the app and its requirements into its virtualenv without index access.
+    """
+    pip = 'pip install -q --no-index --find-links %s' % app.wheelhouse.joinpath('wheels')
+    with virtualenv(str(app.venv)):
+        sudo('%s -U "%s"' % (pip, PIP))
+        sudo('%s %s' % (pip, ' '.join("'%s'" % req for req in app.require_pip)))
+        for name in packages(app):
+            target = app.venv.joinpath('src', name)
+            require.files.directory(str(target), use_sudo=True)
+            # We copy over an existing checkout, to keep files created within it, like
+            # downloads.
+            sudo('cp -R %s/. %s' % (app.wheelhouse.joinpath('src', name), target))
+            sudo('%s -e %s' % (pip, target))